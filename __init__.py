@@ -11,16 +11,31 @@ bl_info= {
     "tracker_url": "",
     "category": 'Object'}
 
+# エクスポート処理のモジュールは使うときに読み込む (再読み込みは読み込み済みのものだけ)
+LAZY_MODULES = ("core.encoder", "core.reducer", "core.compactor", "core.reader", "core.writer", "core.splice", "core",
+    "timing", "pipeline", "cache", "sampler", "fk", "keyframes", "morph", "camera", "exporter", "multi", "batch", "shard")
+
 if "bpy" in locals():
     import imp
-    imp.reload(properties)
-    imp.reload(exporter)
+    import sys
     imp.reload(const)
     imp.reload(logutils)
+    imp.reload(operators)
+    imp.reload(properties)
+    for name in LAZY_MODULES:
+        module = sys.modules.get(__name__ + "." + name)
+        if module is not None:
+            imp.reload(module)
 else:
-    from . import properties, exporter, const, logutils
+    try:
+        import bpy
+    except ImportError:
+        # Blender の外で core だけを使う場合は登録しない
+        bpy = None
+    from . import const
+    if bpy is not None:
+        from . import properties, operators, logutils
 
-import bpy
 import logging
 
 logger = logging.getLogger(const.ADDON_NAME)
@@ -0,0 +1,142 @@
+import bpy
+import concurrent.futures
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from . import const
+from . exporter import Exporter
+
+logger = logging.getLogger(const.ADDON_NAME)
+
+# コマンドラインからまとめてエクスポートする
+#
+# blender -b --addons vmd_exporter --python-expr "import vmd_exporter.batch as b; b.main()" -- jobs.json summary.json [workers]
+#
+# jobs.json はジョブのリスト
+# [{"blend": "a.blend", "armature": "Armature", "action": "Walk", "frame_start": 1, "frame_end": 120, "output": "walk.vmd"}, ...]
+# action, frame_start, frame_end は省略するとファイルの設定を使う
+# ジョブは 1 つずつ別の Blender プロセスで実行する
+
+# エクスポートの前の確認で見つかった問題 (exporter.errors) を持つ例外
+class ExportError(Exception):
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+def main():
+    args = script_args()
+    if len(args) < 2:
+        logger.error("usage : -- jobs.json summary.json [workers]")
+        sys.exit(2)
+
+    with open(args[0], encoding="utf-8") as file:
+        jobs = json.load(file)
+    workers = int(args[2]) if len(args) > 2 else os.cpu_count() or 1
+
+    summary = run_jobs(jobs, workers)
+
+    with open(args[1], "w", encoding="utf-8") as file:
+        json.dump(summary, file, indent=2)
+
+    logger.info("jobs : {0}, failed : {1}, {2:.3f} sec".format(len(jobs), summary["failed"], summary["seconds"]))
+    sys.exit(1 if summary["failed"] else 0)
+
+def script_args():
+    argv = sys.argv
+    return argv[argv.index("--") + 1:] if "--" in argv else []
+
+def run_jobs(jobs, workers):
+    time_start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        results = list(pool.map(run_job_process, jobs))
+
+    return {
+        "workers": workers,
+        "seconds": time.perf_counter() - time_start,
+        "failed": sum(1 for result in results if result["status"] != "ok"),
+        "jobs": results,
+    }
+
+# ジョブを Blender のバックグラウンドプロセスで実行し、結果を返す
+# ジョブの内容が不正な場合も例外を投げずに失敗として返す (サマリーに全てのジョブを残す)
+def run_job_process(job):
+    result = dict(job) if isinstance(job, dict) else {"job": job}
+    time_start = time.perf_counter()
+
+    try:
+        result.update(run_worker(job))
+    except Exception as e:
+        logger.exception("job failed : " + str(result.get("output", "")))
+        result.update({"status": "failed", "error": "{0}: {1}".format(type(e).__name__, e)})
+
+    result["seconds"] = time.perf_counter() - time_start
+    return result
+
+def run_worker(job):
+    handle, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    try:
+        command = [
+            bpy.app.binary_path, "-b", job["blend"],
+            "--addons", __package__,
+            "--python-expr", "import {0}.batch as b; b.worker_main()".format(__package__),
+            "--", json.dumps(job), result_path]
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        with open(result_path, encoding="utf-8") as file:
+            text = file.read()
+    finally:
+        os.remove(result_path)
+
+    if text:
+        result = json.loads(text)
+    else:
+        result = {"status": "failed", "error": "worker exited with code " + str(process.returncode)}
+
+    if result["status"] != "ok":
+        result["log"] = process.stdout.decode("utf-8", "replace")[-4000:]
+    return result
+
+# ジョブを実行するプロセスの入口
+def worker_main():
+    args = script_args()
+    job = json.loads(args[0])
+
+    time_start = time.perf_counter()
+    try:
+        export_job(job)
+        result = {"status": "ok"}
+    except ExportError as e:
+        logger.error("job failed : " + job.get("output", ""))
+        result = {"status": "failed", "error": "{0}: {1}".format(type(e).__name__, e), "errors": e.errors}
+    except Exception as e:
+        logger.exception("job failed : " + job.get("output", ""))
+        result = {"status": "failed", "error": "{0}: {1}".format(type(e).__name__, e)}
+    result["export_seconds"] = time.perf_counter() - time_start
+
+    with open(args[1], "w", encoding="utf-8") as file:
+        json.dump(result, file)
+
+def export_job(job):
+    scene = bpy.context.scene
+    obj = bpy.data.objects[job["armature"]]
+    if obj.type != 'ARMATURE':
+        raise ValueError("not an armature : " + obj.name)
+
+    if job.get("action"):
+        if obj.animation_data is None:
+            obj.animation_data_create()
+        obj.animation_data.action = bpy.data.actions[job["action"]]
+
+    exporter = Exporter(scene, obj)
+    if "frame_start" in job or "frame_end" in job:
+        exporter.set_frame_range(job.get("frame_start", exporter.frame_start), job.get("frame_end", exporter.frame_end))
+    exporter.output_path = bpy.path.abspath(job["output"])
+
+    if not exporter.export_vmd():
+        raise ExportError(exporter.errors or ["nothing exported (no bones to export or no frames in range)"])
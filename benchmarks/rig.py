@@ -0,0 +1,150 @@
+import math
+import numpy
+import types
+from . standin import Matrix, property_values
+
+# ボーン数、階層の深さ、フレーム数、マーカーの密度を指定して合成したアーマチュアとシーン
+# ポーズ行列は生成時に全フレーム分を計算しておき、frame_set では切り替えるだけにする
+# (計測するのはエクスポート側の処理)
+
+class Bone():
+    def __init__(self, name, matrix_local, properties):
+        self.name = name
+        self.matrix_local = matrix_local
+        self.vmd_bone_properties = properties
+
+class PoseBone():
+    def __init__(self, pose, index, bone):
+        self.pose = pose
+        self.index = index
+        self.name = bone.name
+        self.bone = bone
+        self.parent = None
+        self.constraints = []
+
+    @property
+    def matrix(self):
+        return Matrix(self.pose.matrices[self.pose.frame_index, self.index])
+
+    @property
+    def parent_recursive(self):
+        parents = []
+        parent = self.parent
+        while parent is not None:
+            parents.append(parent)
+            parent = parent.parent
+        return parents
+
+    def path_from_id(self, name=None):
+        path = 'pose.bones["' + self.name + '"]'
+        return path + "." + name if name else path
+
+class BoneCollection(list):
+    def __init__(self, bones):
+        super().__init__(bones)
+        self.map = {bone.name: bone for bone in bones}
+
+    def __contains__(self, name):
+        return name in self.map
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.map[key]
+        return super().__getitem__(key)
+
+    # Blender と同じく列優先で詰める
+    def foreach_get(self, attribute, buffer):
+        pose = self[0].pose
+        buffer[:] = pose.matrices[pose.frame_index].transpose(0, 2, 1).ravel()
+
+class Pose():
+    def __init__(self, matrices, frame_start):
+        self.matrices = matrices
+        self.frame_start = frame_start
+        self.frame_index = 0
+        self.bones = None
+
+class Scene():
+    def __init__(self, rig, markers):
+        self.rig = rig
+        self.timeline_markers = [types.SimpleNamespace(frame=frame) for frame in markers]
+        self.frame_current = rig.pose.frame_start
+
+    def frame_set(self, frame):
+        self.frame_current = frame
+        pose = self.rig.pose
+        pose.frame_index = min(max(frame - pose.frame_start, 0), len(pose.matrices) - 1)
+
+def translation(x, y, z):
+    matrix = numpy.identity(4)
+    matrix[:3, 3] = (x, y, z)
+    return matrix
+
+def rotation(axis, angles):
+    # angles (F,) -> (F, 4, 4)
+    cos = numpy.cos(angles)
+    sin = numpy.sin(angles)
+    matrices = numpy.zeros((len(angles), 4, 4))
+    matrices[:, 3, 3] = 1.0
+    i, j = [(1, 2), (2, 0), (0, 1)][axis]
+    matrices[:, axis, axis] = 1.0
+    matrices[:, i, i] = cos
+    matrices[:, i, j] = -sin
+    matrices[:, j, i] = sin
+    matrices[:, j, j] = cos
+    return matrices
+
+# bone_count 本のボーンを depth の深さの鎖にしてルートにつなぐ
+def generate(bone_count, depth, frame_count, marker_density, armature_properties, frame_start=1, seed=0):
+    random = numpy.random.RandomState(seed)
+    depth = max(depth, 1)
+
+    parents = []
+    for i in range(bone_count):
+        if i == 0 or depth == 1:
+            parents.append(None)
+        elif (i - 1) % (depth - 1) == 0:
+            parents.append(0)
+        else:
+            parents.append(i - 1)
+
+    rests = []
+    for i, parent in enumerate(parents):
+        local = translation(*random.uniform(-0.5, 0.5, 3)).dot(rotation(i % 3, numpy.array([random.uniform(-1.0, 1.0)]))[0])
+        rests.append(local if parent is None else rests[parent].dot(translation(0.0, 1.0, 0.0)).dot(local))
+
+    # 各ボーンを親に対して揺らし、ルートは移動もさせる
+    times = numpy.arange(frame_count, dtype=numpy.float64)
+    matrices = numpy.zeros((frame_count, bone_count, 4, 4))
+    for i, parent in enumerate(parents):
+        frequency, phase, amplitude = random.uniform(0.02, 0.2), random.uniform(0.0, math.pi), random.uniform(0.1, 1.0)
+        basis = rotation(i % 3, amplitude * numpy.sin(times * frequency + phase))
+        # 一部のボーンは途中で止める (変化のない区間)
+        if i % 4 == 3:
+            basis[frame_count // 2:] = basis[frame_count // 2]
+        if parent is None:
+            basis[:, :3, 3] = numpy.sin(times * frequency)[:, numpy.newaxis] * random.uniform(-1.0, 1.0, 3)
+            matrices[:, i] = numpy.matmul(rests[i], basis)
+        else:
+            relative = numpy.linalg.inv(rests[parent]).dot(rests[i])
+            matrices[:, i] = numpy.matmul(numpy.matmul(matrices[:, parent], relative), basis)
+
+    bones = [Bone("bone{0:03d}".format(i), Matrix(rests[i]), types.SimpleNamespace(export=True, mmd_name="", mmd_parent="")) for i in range(bone_count)]
+    pose = Pose(matrices, frame_start)
+    pose.bones = BoneCollection([PoseBone(pose, i, bone) for i, bone in enumerate(bones)])
+    for pose_bone, parent in zip(pose.bones, parents):
+        pose_bone.parent = None if parent is None else pose.bones[parent]
+
+    arm = types.SimpleNamespace(name="Armature", bones=BoneCollection(bones), vmd_armature_properties=armature_properties)
+    rig = types.SimpleNamespace(name="Armature", type='ARMATURE', data=arm, pose=pose, animation_data=None)
+
+    frame_end = frame_start + frame_count - 1
+    marker_count = int(round(frame_count * marker_density))
+    markers = sorted(random.choice(numpy.arange(frame_start, frame_end + 1), marker_count, replace=False).tolist()) if marker_count else []
+
+    armature_properties.frame_start = frame_start
+    armature_properties.frame_end = frame_end
+    return Scene(rig, markers), rig
+
+def armature_properties(properties_module, **values):
+    return property_values(properties_module.VMDArmatureProperties, **values)
@@ -0,0 +1,135 @@
+import argparse
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from . import rig, standin
+
+# Blender を使わずに合成したリグでエクスポートを計測し、基準値と比べる
+#
+# python -m benchmarks.run [--update-baseline] [--bones N --depth N --frames N --marker-density X]
+#
+# 出力のハッシュが基準値と違う場合と、records/sec が基準値の (1 - tolerance) 倍を下回った場合は失敗にする
+
+PACKAGE_NAME = "vmd_exporter"
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+SCENARIOS = [
+    {"name": "bake", "bones": 100, "depth": 5, "frames": 600, "marker_density": 0.0, "properties": {}},
+    {"name": "markers", "bones": 100, "depth": 5, "frames": 600, "marker_density": 0.1, "properties": {"use_marker_mode": True}},
+    {"name": "reduction", "bones": 30, "depth": 4, "frames": 240, "marker_density": 0.0, "properties": {"use_reduction": True}},
+]
+
+def load_package():
+    standin.install()
+    spec = importlib.util.spec_from_file_location(PACKAGE_NAME, os.path.join(PACKAGE_PATH, "__init__.py"), submodule_search_locations=[PACKAGE_PATH])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = package
+    spec.loader.exec_module(package)
+    # エクスポート処理はアドオンの登録では読み込まれない
+    for name in ("exporter", "core"):
+        importlib.import_module(PACKAGE_NAME + "." + name)
+    logging.getLogger(package.const.ADDON_NAME).setLevel(logging.WARNING)
+    return package
+
+def run_scenario(package, scenario, output_dir):
+    seconds, data = export_scenario(package, scenario, output_dir, False)
+    # tracemalloc は遅くなるので、メモリは別に計測する
+    peak_memory = export_scenario(package, scenario, output_dir, True)[0]
+    records = len(package.core.reader.read_bone_records(data)[2])
+
+    return {
+        "seconds": seconds,
+        "records": records,
+        "bytes": len(data),
+        "records_per_sec": records / seconds,
+        "bytes_per_sec": len(data) / seconds,
+        "peak_memory": peak_memory,
+        "sha1": hashlib.sha1(data).hexdigest(),
+    }
+
+# (秒数またはメモリのピーク, 出力) を返す
+def export_scenario(package, scenario, output_dir, trace_memory):
+    properties = rig.armature_properties(package.properties, **scenario["properties"])
+    scene, obj = rig.generate(scenario["bones"], scenario["depth"], scenario["frames"], scenario["marker_density"], properties)
+
+    exporter = package.exporter.Exporter(scene, obj)
+    exporter.output_path = os.path.join(output_dir, scenario["name"] + ".vmd")
+
+    if trace_memory:
+        tracemalloc.start()
+    time_start = time.perf_counter()
+    exported = exporter.export_vmd()
+    measure = time.perf_counter() - time_start
+    if trace_memory:
+        measure = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if not exported:
+        raise RuntimeError("nothing exported : " + scenario["name"])
+
+    with open(exporter.output_path, "rb") as file:
+        data = file.read()
+    return measure, data
+
+# 基準値と比べ、問題のリストを返す
+def check(name, result, baseline, tolerance):
+    if baseline is None:
+        return []
+    problems = []
+    if result["sha1"] != baseline["sha1"]:
+        problems.append(name + " : output changed")
+    if result["records_per_sec"] < baseline["records_per_sec"] * (1.0 - tolerance):
+        problems.append("{0} : {1:.0f} records/sec < {2:.0f} (baseline)".format(name, result["records_per_sec"], baseline["records_per_sec"]))
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--bones", type=int)
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--marker-density", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    scenarios = SCENARIOS
+    if args.bones:
+        properties = {"use_marker_mode": True} if args.marker_density > 0.0 else {}
+        scenarios = [{"name": "custom", "bones": args.bones, "depth": args.depth, "frames": args.frames, "marker_density": args.marker_density, "properties": properties}]
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as file:
+            baselines = json.load(file)
+
+    package = load_package()
+    results = {}
+    problems = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for scenario in scenarios:
+            result = run_scenario(package, scenario, output_dir)
+            results[scenario["name"]] = result
+            problems += check(scenario["name"], result, baselines.get(scenario["name"]), args.tolerance)
+            print("{0:10s} {1:9.0f} records/sec {2:12.0f} bytes/sec {3:10d} bytes peak  {4}".format(
+                scenario["name"], result["records_per_sec"], result["bytes_per_sec"], result["peak_memory"], result["sha1"][:12]))
+
+    if args.update_baseline:
+        baselines.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+        return 0
+
+    for problem in problems:
+        print("REGRESSION " + problem)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
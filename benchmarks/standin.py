@@ -0,0 +1,143 @@
+import sys
+import types
+import numpy
+
+# Blender の外でエクスポート処理を動かすための bpy, mathutils の代わり
+# エクスポートで使う範囲だけを実装する
+
+# bpy.props の関数の代わり (宣言を残しておき、既定値を取り出せるようにする)
+class PropertyStandin():
+    def __init__(self, kind, kwargs):
+        self.kind = kind
+        self.kwargs = kwargs
+
+    def default(self):
+        if "default" in self.kwargs:
+            return self.kwargs["default"]
+        if self.kind == "PointerProperty":
+            return None
+        if self.kind == "IntVectorProperty":
+            return (0, 0, 0)
+        if self.kind == "EnumProperty":
+            return self.kwargs["items"][0][0]
+        return {"BoolProperty": False, "IntProperty": 0, "FloatProperty": 0.0, "StringProperty": ""}.get(self.kind)
+
+def property_function(kind):
+    def function(**kwargs):
+        return PropertyStandin(kind, kwargs)
+    return function
+
+# PropertyGroup のクラスから、既定値を持つインスタンスの代わりを作る
+def property_values(cls, **values):
+    namespace = types.SimpleNamespace()
+    for name in dir(cls):
+        value = getattr(cls, name)
+        if isinstance(value, PropertyStandin):
+            setattr(namespace, name, value.default())
+    for name, value in values.items():
+        setattr(namespace, name, value)
+    return namespace
+
+class StandinType():
+    def __init__(self, *args, **kwargs):
+        pass
+
+class TypesModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        cls = type(name, (StandinType,), {})
+        setattr(self, name, cls)
+        return cls
+
+class Matrix():
+    def __init__(self, rows=None):
+        self.array = numpy.identity(4) if rows is None else numpy.array(rows, dtype=numpy.float64)
+
+    def __mul__(self, other):
+        if isinstance(other, Matrix):
+            return Matrix(numpy.matmul(self.array, other.array))
+        vector = numpy.array(tuple(other), dtype=numpy.float64)
+        if len(vector) == 3 and len(self.array) == 4:
+            return Vector(numpy.matmul(self.array, numpy.append(vector, 1.0))[:3])
+        return Vector(numpy.matmul(self.array, vector))
+
+    def __iter__(self):
+        return iter(Vector(row) for row in self.array)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return Vector(self.array[index])
+
+    @property
+    def col(self):
+        return [Vector(column) for column in self.array.T]
+
+    def inverted(self):
+        return Matrix(numpy.linalg.inv(self.array))
+
+    def normalized(self):
+        return Matrix(self.array / numpy.linalg.norm(self.array, axis=0))
+
+    def to_3x3(self):
+        return Matrix(self.array[:3, :3])
+
+    def to_translation(self):
+        return Vector(self.array[:3, 3])
+
+class Vector():
+    def __init__(self, values):
+        self.array = numpy.array(tuple(values), dtype=numpy.float64)
+
+    x = property(lambda self: float(self.array[0]))
+    y = property(lambda self: float(self.array[1]))
+    z = property(lambda self: float(self.array[2]))
+
+    def __iter__(self):
+        return iter(self.array.tolist())
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return float(self.array[index])
+
+    def __add__(self, other):
+        return Vector(self.array + numpy.array(tuple(other)))
+
+    def __sub__(self, other):
+        return Vector(self.array - numpy.array(tuple(other)))
+
+    # Vector * Matrix は行ベクトルとして掛ける (4x4 の場合は w = 1 を足す)
+    def __mul__(self, other):
+        if isinstance(other, Matrix):
+            vector = self.array
+            if len(vector) == 3 and len(other.array) == 4:
+                vector = numpy.append(vector, 1.0)
+            return Vector(numpy.matmul(vector, other.array)[:len(self.array)])
+        return Vector(self.array * other)
+
+def install():
+    bpy = types.ModuleType("bpy")
+    bpy.types = TypesModule("bpy.types")
+    bpy.props = types.ModuleType("bpy.props")
+    for kind in ("PointerProperty", "StringProperty", "CollectionProperty", "IntProperty", "BoolProperty", "IntVectorProperty",
+            "FloatVectorProperty", "FloatProperty", "EnumProperty", "BoolVectorProperty"):
+        setattr(bpy.props, kind, property_function(kind))
+    bpy.utils = types.ModuleType("bpy.utils")
+    bpy.utils.previews = types.ModuleType("bpy.utils.previews")
+    bpy.app = types.ModuleType("bpy.app")
+    bpy.app.translations = types.ModuleType("bpy.app.translations")
+    bpy.app.translations.pgettext = lambda text: text
+    bpy.app.binary_path = ""
+    bpy.path = types.ModuleType("bpy.path")
+    bpy.path.abspath = lambda path: path
+
+    mathutils = types.ModuleType("mathutils")
+    mathutils.Matrix = Matrix
+    mathutils.Vector = Vector
+
+    for module in (bpy, bpy.types, bpy.props, bpy.utils, bpy.utils.previews, bpy.app, bpy.app.translations, bpy.path, mathutils):
+        sys.modules[module.__name__] = module
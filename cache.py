@@ -0,0 +1,133 @@
+import collections
+import hashlib
+import logging
+import os
+import struct
+from . import const
+from . core import writer
+
+logger = logging.getLogger(const.ADDON_NAME)
+
+# ファイルの形式: MAGIC, バージョン, 件数, (キーの長さ, キー, データの長さ, データ) * 件数
+# 古く使われたものから順に書く (読み込んだ順がそのまま LRU の順になる)
+MAGIC = b"VMDC"
+CACHE_VERSION = 2
+HEADER = struct.Struct("<4sII")
+LENGTH = struct.Struct("<I")
+
+# VMD の横に置く、フレームごとのボーンキーフレームのキャッシュ
+# キーは入力のフィンガープリント、値は 1 フレーム分のキーフレームのバイト列
+# 合計サイズが max_size を超えたら古く使われたものから捨てる (読み込み中とエクスポート中も)
+class RecordCache():
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+            entries = read_entries(data)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("broken cache : " + self.path + " (" + str(e) + ")")
+            return
+        if entries is None:
+            return
+
+        for key, value in entries:
+            self.put(key, value)
+        logger.info("cache : " + str(len(self.entries)) + " frames, " + str(self.size) + " bytes")
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = data
+        self.size += len(data)
+        self.evict()
+
+    def evict(self):
+        while self.entries and self.size > self.max_size:
+            key, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+
+    def save(self):
+        with writer.atomic_file(self.path) as file:
+            file.write(HEADER.pack(MAGIC, CACHE_VERSION, len(self.entries)))
+            for key, data in self.entries.items():
+                file.write(LENGTH.pack(len(key)))
+                file.write(key)
+                file.write(LENGTH.pack(len(data)))
+                file.write(data)
+
+        logger.info("cache hits : " + str(self.hits) + ", misses : " + str(self.misses) + ", size : " + str(self.size) + " bytes")
+
+# [(キー, データ)] を返す (違うバージョンの場合は None)
+def read_entries(data):
+    magic, version, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("not a cache file")
+    if version != CACHE_VERSION:
+        return None
+
+    entries = []
+    offset = HEADER.size
+    for i in range(count):
+        key, offset = read_bytes(data, offset)
+        value, offset = read_bytes(data, offset)
+        entries.append((key, value))
+    return entries
+
+def read_bytes(data, offset):
+    size = LENGTH.unpack_from(data, offset)[0]
+    offset += LENGTH.size
+    if offset + size > len(data):
+        raise ValueError("truncated cache")
+    return data[offset:offset + size], offset + size
+
+# エクスポート全体で変わらない入力と、フレームごとの F-Curve の値からキーを作る
+class Fingerprint():
+    def __init__(self, exporter):
+        animation_data = exporter.obj.animation_data
+        action = animation_data.action if animation_data else None
+        self.fcurves = list(action.fcurves) if action else []
+
+        digest = hashlib.sha1()
+        digest.update(repr((
+            exporter.scale,
+            exporter.frame_offset,
+            exporter.ipo,
+            action.name if action else "",
+            [(fcurve.data_path, fcurve.array_index) for fcurve in self.fcurves],
+            # 出力しない親でも、レストは親に対する位置 (offset) に影響する
+            [(entry.name, entry.pose_bone.name, entry.parent.name if entry.parent else "", matrix_rows(entry.pose_bone.bone.matrix_local),
+                matrix_rows(entry.parent.bone.matrix_local) if entry.parent else ()) for entry in exporter.bone_table],
+        )).encode("utf-8"))
+        self.base = digest.digest()
+
+        self.values = struct.Struct("<i{0}d".format(len(self.fcurves)))
+
+    def frame_key(self, frame):
+        digest = hashlib.sha1(self.base)
+        digest.update(self.values.pack(frame, *[fcurve.evaluate(frame) for fcurve in self.fcurves]))
+        return digest.digest()
+
+def matrix_rows(matrix):
+    return [tuple(row) for row in matrix]
@@ -0,0 +1,125 @@
+import math
+import numpy
+from . import sampler
+from . core import encoder, reducer
+
+# ボーンと同じフレームのループでカメラと照明を読み、値が変わったキーフレームだけを残す
+#
+# VMD の座標は Blender の X, Z, Y (ボーンと同じ)
+# MMD のカメラは回転 0 で +Z を向き、注視点から (0, 0, 距離) の位置にある
+# 回転は Y, X, Z の順 (R = Ry * Rx * Rz)
+# 注視点までの距離はピントを合わせるオブジェクトまでの視線方向の距離 (なければピントの距離)
+
+class CameraSampler(sampler.FrameSampler):
+    def __init__(self, obj, scene, scale):
+        super().__init__()
+        self.obj = obj
+        self.scene = scene
+        self.scale = scale
+
+    def sample(self, frame):
+        camera = self.obj.data
+        matrix = self.obj.matrix_world
+        rotation = matrix.to_3x3().normalized()
+
+        direction = rotation.col[2] * -1.0
+        up = rotation.col[1]
+        distance = focus_distance(camera, matrix.to_translation(), direction)
+        center = matrix.to_translation() + direction * distance
+
+        self.frames.append(frame)
+        self.values.append((
+            -distance * self.scale,
+            center.x * self.scale, center.z * self.scale, center.y * self.scale)
+            + mmd_camera_rotation((direction.x, direction.z, direction.y), (up.x, up.z, up.y))
+            + (round(math.degrees(vertical_angle(camera, self.scene.render))), 1 if camera.type == 'ORTHO' else 0))
+
+    def records(self, frame_offset):
+        frames, values = sorted_values(self.frames, self.values)
+        if len(frames) <= 0:
+            return numpy.zeros(0, dtype=encoder.CAMERA_RECORD_DTYPE)
+
+        # 線形補間で逆回りしないように角度をつなげる
+        values[:, 4:7] = numpy.unwrap(values[:, 4:7], axis=0)
+
+        keep = reducer.keep_changes(values.astype(numpy.float32)).any(axis=1)
+        records = numpy.zeros(numpy.count_nonzero(keep), dtype=encoder.CAMERA_RECORD_DTYPE)
+        records["frame"] = frames[keep] + frame_offset
+        records["distance"] = values[keep, 0]
+        records["location"] = values[keep, 1:4]
+        records["rotation"] = values[keep, 4:7]
+        records["ipo"] = numpy.frombuffer(encoder.CAMERA_LINEAR_IPO, dtype=numpy.uint8)
+        records["view_angle"] = values[keep, 7]
+        records["perspective"] = values[keep, 8]
+        return records
+
+class LightSampler(sampler.FrameSampler):
+    def __init__(self, obj):
+        super().__init__()
+        self.obj = obj
+
+    def sample(self, frame):
+        # 照明の方向はランプの -Z
+        direction = self.obj.matrix_world.to_3x3().normalized().col[2] * -1.0
+        color = self.obj.data.color
+
+        self.frames.append(frame)
+        self.values.append((color[0], color[1], color[2], direction.x, direction.z, direction.y))
+
+    def records(self, frame_offset):
+        frames, values = sorted_values(self.frames, self.values)
+        if len(frames) <= 0:
+            return numpy.zeros(0, dtype=encoder.LIGHT_RECORD_DTYPE)
+
+        keep = reducer.keep_changes(values.astype(numpy.float32)).any(axis=1)
+        records = numpy.zeros(numpy.count_nonzero(keep), dtype=encoder.LIGHT_RECORD_DTYPE)
+        records["frame"] = frames[keep] + frame_offset
+        records["color"] = values[keep, 0:3]
+        records["direction"] = values[keep, 3:6]
+        return records
+
+# ピントを合わせるオブジェクトがあればそこまでの視線方向の距離、なければピントの距離
+def focus_distance(camera, location, direction):
+    if camera.dof_object is None:
+        return camera.dof_distance
+    return (camera.dof_object.matrix_world.to_translation() - location).dot(direction)
+
+def sorted_values(frames, values):
+    frames = numpy.array(frames, dtype=numpy.int64)
+    values = numpy.array(values, dtype=numpy.float64).reshape(len(frames), -1)
+    order = numpy.argsort(frames, kind="mergesort")
+    return frames[order], values[order]
+
+# VMD の座標系の視線と上方向から MMD のカメラの回転 (x, y, z) を返す
+def mmd_camera_rotation(direction, up):
+    z_axis = normalize(direction)
+    x_axis = normalize(cross(up, z_axis))
+    y_axis = cross(z_axis, x_axis)
+
+    # R = Ry * Rx * Rz の列が x_axis, y_axis, z_axis
+    rotation_x = math.asin(max(-1.0, min(1.0, -z_axis[1])))
+    rotation_y = math.atan2(z_axis[0], z_axis[2])
+    rotation_z = math.atan2(x_axis[1], y_axis[1])
+    return (rotation_x, rotation_y, rotation_z)
+
+def normalize(vector):
+    length = math.sqrt(sum(v * v for v in vector))
+    return tuple(v / length for v in vector)
+
+def cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+# MMD の視野角は縦の角度
+def vertical_angle(camera, render):
+    width = render.resolution_x * render.pixel_aspect_x
+    height = render.resolution_y * render.pixel_aspect_y
+
+    sensor_fit = camera.sensor_fit
+    if sensor_fit == 'AUTO':
+        if width < height:
+            return camera.angle
+        sensor_fit = 'HORIZONTAL'
+
+    if sensor_fit == 'VERTICAL':
+        return camera.angle_y
+    return 2.0 * math.atan(math.tan(camera.angle_x * 0.5) * height / width)
@@ -1,4 +1,3 @@
 ADDON_NAME = "vmd_exporter"
 LOG_FILE_NAME = "vmd_exporter.log"
-META = "Vocaloid Motion Data 0002"
 
@@ -0,0 +1,7 @@
+# bpy に依存しない VMD の読み書き (Python と NumPy だけで動く)
+#
+# from vmd_exporter.core import writer
+# with open("out.vmd", "wb") as file:
+#     writer.write_vmd(file, "model", bones=writer.bone_records(names, frames, locations, quaternions))
+
+from . import compactor, encoder, reader, reducer, splice, writer
@@ -0,0 +1,71 @@
+import numpy
+from . import encoder, reducer
+
+# 補間しても姿勢が変わらないキーフレームを除く (可逆)
+#
+# 前後のキーフレームと位置と回転が float32 で同じキーフレームは、補間曲線によらず同じ値の区間の途中なので除ける
+# 最後に同じ値が続く区間は最初のキーフレームだけを残す (最後のキーフレーム以降は値が保たれる)
+# 動かないボーンはキーフレーム 1 つになる
+
+class CompactionStats():
+    def __init__(self):
+        self.input_count = 0
+        self.output_count = 0
+
+    @property
+    def removed_count(self):
+        return self.input_count - self.output_count
+
+    def __str__(self):
+        return "duplicate keys removed : {0} ({1} -> {2})".format(self.removed_count, self.input_count, self.output_count)
+
+# values は (キーフレーム数, ..., チャンネル数) で、残すキーフレームを True にした (キーフレーム数, ...) の配列を返す
+def compact_keys(values):
+    if len(values) <= 0:
+        return numpy.zeros(values.shape[:-1], dtype=bool)
+
+    keep = reducer.keep_changes(values).any(axis=-1)
+    if len(values) > 1:
+        keep[-1] &= ~(values[-1] == values[-2]).all(axis=-1)
+    return keep
+
+# BONE_RECORD_DTYPE の配列から位置と回転を (..., 7) の float32 で返す
+def record_values(records):
+    return numpy.concatenate((records["location"], records["quaternion"]), axis=-1)
+
+# 1 フレーム分のボーンキーフレームを書くたびに、1 フレーム前のキーフレームのうち残すものだけを file に書く
+# write にはフレーム順に、同じボーンの並びのキーフレームを 1 フレーム分ずつ渡す
+class BoneFrameCompactor():
+    def __init__(self, file, stats=None):
+        self.file = file
+        self.stats = stats if stats is not None else CompactionStats()
+        self.previous = None
+        self.previous_values = None
+        self.previous_same = None
+
+    def write(self, data):
+        records = numpy.frombuffer(data, dtype=encoder.BONE_RECORD_DTYPE)
+        values = record_values(records)
+        self.stats.input_count += len(records)
+
+        if self.previous is None:
+            same = numpy.zeros(len(records), dtype=bool)
+        else:
+            same = (values == self.previous_values).all(axis=1)
+            self.emit(self.previous[~(self.previous_same & same)])
+
+        self.previous = records.copy()
+        self.previous_values = values
+        self.previous_same = same
+
+    # 最後のフレームを書く (前のフレームと同じ値のキーフレームは除く)
+    def finish(self):
+        if self.previous is not None:
+            self.emit(self.previous[~self.previous_same])
+            self.previous = None
+
+    def emit(self, records):
+        if len(records) <= 0:
+            return
+        self.file.write(records.tobytes())
+        self.stats.output_count += len(records)
@@ -0,0 +1,116 @@
+import numpy
+import struct
+
+# ヘッダーの先頭 30 byte
+META = "Vocaloid Motion Data 0002"
+
+# VMD は全てリトルエンディアン (プラットフォームの "L" のサイズに依存しない)
+UINT32 = struct.Struct("<I")
+
+# ボーンキーフレーム (111 byte)
+# ボーン名(15) フレーム番号(4) 位置(4*3) 回転(4*4) 補間(64)
+BONE_RECORD = struct.Struct("<15sI3f4f64s")
+
+# BONE_RECORD と同じレイアウトの構造化配列
+BONE_RECORD_DTYPE = numpy.dtype([
+    ("name", "S15"),
+    ("frame", "<u4"),
+    ("location", "<f4", (3,)),
+    ("quaternion", "<f4", (4,)),
+    ("ipo", "u1", (64,))])
+
+# 表情キーフレーム (23 byte)
+# 表情名(15) フレーム番号(4) ウェイト(4)
+MORPH_RECORD_DTYPE = numpy.dtype([
+    ("name", "S15"),
+    ("frame", "<u4"),
+    ("weight", "<f4")])
+
+# カメラキーフレーム (61 byte)
+# フレーム番号(4) 距離(4) 位置(4*3) 回転(4*3) 補間(24) 視野角(4) パースペクティブ(1)
+CAMERA_RECORD_DTYPE = numpy.dtype([
+    ("frame", "<u4"),
+    ("distance", "<f4"),
+    ("location", "<f4", (3,)),
+    ("rotation", "<f4", (3,)),
+    ("ipo", "u1", (24,)),
+    ("view_angle", "<u4"),
+    ("perspective", "u1")])
+
+# 照明キーフレーム (28 byte)
+# フレーム番号(4) 色(4*3) 方向(4*3)
+LIGHT_RECORD_DTYPE = numpy.dtype([
+    ("frame", "<u4"),
+    ("color", "<f4", (3,)),
+    ("direction", "<f4", (3,))])
+
+# セルフ影キーフレーム (9 byte)
+# フレーム番号(4) モード(1) 距離(4)
+SELF_SHADOW_RECORD_DTYPE = numpy.dtype([
+    ("frame", "<u4"),
+    ("mode", "u1"),
+    ("distance", "<f4")])
+
+# ボーンキーフレームを連続したバッファに詰めて、まとめて書き出す
+class BoneRecordBuffer():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray(BONE_RECORD.size * capacity)
+        self.count = 0
+
+    def append(self, name, frame, location, quaternion, ipo):
+        if self.count >= self.capacity:
+            self.grow()
+
+        BONE_RECORD.pack_into(self.buffer, self.count * BONE_RECORD.size,
+            name, frame,
+            location[0], location[1], location[2],
+            quaternion[0], quaternion[1], quaternion[2], quaternion[3],
+            ipo)
+        self.count += 1
+
+    def grow(self):
+        self.buffer.extend(bytearray(BONE_RECORD.size * self.capacity))
+        self.capacity *= 2
+
+    def getvalue(self):
+        return memoryview(self.buffer)[:self.count * BONE_RECORD.size]
+
+    def flush(self, file):
+        if self.count <= 0:
+            return
+        file.write(self.getvalue())
+        self.count = 0
+
+# 名前と補間データを埋めたボーンキーフレームの配列を作る
+# フレームごとに frame, location, quaternion だけを書き換えて使い回す
+def bone_record_array(names, ipo):
+    records = numpy.zeros(len(names), dtype=BONE_RECORD_DTYPE)
+    records["name"] = names
+    records["ipo"] = numpy.frombuffer(ipo, dtype=numpy.uint8)
+    return records
+
+# 補間曲線の制御点 (x1, y1, x2, y2) 0-127
+LINEAR_CURVE = (20, 20, 107, 107)
+
+# X, Y, Z, 回転 の補間曲線から 64 byte の補間データを作る
+def build_ipo(x_curve, y_curve, z_curve, r_curve):
+    curves = (x_curve, y_curve, z_curve, r_curve)
+    row = [curve[i] for i in range(4) for curve in curves]
+
+    # 2 行目以降は 1 byte ずつずらした複製
+    ipo = []
+    for i in range(4):
+        ipo.extend(row[i:])
+        ipo.extend([0] * i)
+
+    # 1 行目の 3, 4 byte 目は物理演算のフラグとして使われる
+    ipo[2] = 0
+    ipo[3] = 0
+    return bytes(ipo)
+
+LINEAR_IPO = build_ipo(LINEAR_CURVE, LINEAR_CURVE, LINEAR_CURVE, LINEAR_CURVE)
+
+# カメラの補間データ (24 byte)
+# X, Y, Z, 回転, 距離, 視野角 の順に (x1, x2, y1, y2)
+CAMERA_LINEAR_IPO = bytes([20, 107, 20, 107] * 6)
@@ -0,0 +1,139 @@
+import math
+import mmap
+import numpy
+import sys
+from . import encoder
+
+# VMD ファイルをメモリマップで開き、ボーンキーフレームを配列のビューとして返す
+# 配列はファイルの内容をコピーしないので、close する前に参照を捨てること
+class VmdFile():
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        self.meta, self.name, self.bones = read_bone_records(self.mmap)
+
+    def close(self):
+        self.bones = None
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# (ヘッダー, モデル名, ボーンキーフレームの構造化配列) を返す
+def read_bone_records(buffer):
+    meta = bytes(buffer[:30])
+    # 古い形式はモデル名が 10 byte
+    name_size = 20 if meta.startswith(encoder.META.encode("shift_jis")) else 10
+    name = bytes(buffer[30:30 + name_size])
+
+    offset = 30 + name_size
+    if len(buffer) < offset + encoder.UINT32.size:
+        raise ValueError("not a VMD file")
+    count = encoder.UINT32.unpack_from(buffer, offset)[0]
+    offset += encoder.UINT32.size
+
+    if len(buffer) < offset + count * encoder.BONE_RECORD_DTYPE.itemsize:
+        raise ValueError("truncated bone keyframes : " + str(count))
+    bones = numpy.frombuffer(buffer, dtype=encoder.BONE_RECORD_DTYPE, count=count, offset=offset)
+    return decode_name(meta), decode_name(name), bones
+
+def decode_name(data):
+    return data.split(b"\0", 1)[0].decode("shift_jis", "replace")
+
+class BoneError():
+    __slots__ = ("name", "keys", "location", "angle")
+
+    def __init__(self, name, keys, location, angle):
+        self.name = name
+        self.keys = keys
+        self.location = location
+        self.angle = angle
+
+    def __str__(self):
+        return "{0} : {1} keys, max location error : {2:.6f}, max angle error : {3:.4f} deg".format(
+            self.name, self.keys, self.location, math.degrees(self.angle))
+
+class Comparison():
+    def __init__(self, bones, only_a, only_b):
+        self.bones = bones
+        self.only_a = only_a
+        self.only_b = only_b
+
+    @property
+    def max_location_error(self):
+        return max((bone.location for bone in self.bones), default=0.0)
+
+    @property
+    def max_angle_error(self):
+        return max((bone.angle for bone in self.bones), default=0.0)
+
+    def __str__(self):
+        lines = [str(bone) for bone in self.bones]
+        lines.append("only in a : {0}, only in b : {1}, max location error : {2:.6f}, max angle error : {3:.4f} deg".format(
+            self.only_a, self.only_b, self.max_location_error, math.degrees(self.max_angle_error)))
+        return "\n".join(lines)
+
+# 同じボーン名とフレーム番号のキーフレームを比べ、ボーンごとの最大誤差を返す
+# a, b は BONE_RECORD_DTYPE の配列 (VmdFile.bones や encoder.bone_record_array の結果)
+def compare(a, b):
+    names, ids = numpy.unique(numpy.concatenate([a["name"], b["name"]]), return_inverse=True)
+    ids_a = ids[:len(a)].astype(numpy.uint64)
+    ids_b = ids[len(a):].astype(numpy.uint64)
+    keys_a = (ids_a << numpy.uint64(32)) | a["frame"].astype(numpy.uint64)
+    keys_b = (ids_b << numpy.uint64(32)) | b["frame"].astype(numpy.uint64)
+
+    order_b = numpy.argsort(keys_b, kind="mergesort")
+    sorted_b = keys_b[order_b]
+    position = numpy.searchsorted(sorted_b, keys_a)
+    position[position >= len(sorted_b)] = 0
+    found = sorted_b[position] == keys_a if len(sorted_b) else numpy.zeros(len(keys_a), dtype=bool)
+
+    index_a = numpy.nonzero(found)[0]
+    index_b = order_b[position[found]]
+
+    location_a = a["location"][index_a].astype(numpy.float64)
+    location_b = b["location"][index_b].astype(numpy.float64)
+    location_error = numpy.linalg.norm(location_a - location_b, axis=1)
+
+    quaternion_a = a["quaternion"][index_a].astype(numpy.float64)
+    quaternion_b = b["quaternion"][index_b].astype(numpy.float64)
+    quaternion_a /= numpy.linalg.norm(quaternion_a, axis=1)[:, numpy.newaxis]
+    quaternion_b /= numpy.linalg.norm(quaternion_b, axis=1)[:, numpy.newaxis]
+    dot = numpy.minimum(numpy.abs(numpy.einsum("ni,ni->n", quaternion_a, quaternion_b)), 1.0)
+    angle_error = 2.0 * numpy.arccos(dot)
+
+    matched = ids_a[index_a].astype(numpy.intp)
+    keys = numpy.bincount(matched, minlength=len(names))
+    max_location = numpy.zeros(len(names))
+    max_angle = numpy.zeros(len(names))
+    numpy.maximum.at(max_location, matched, location_error)
+    numpy.maximum.at(max_angle, matched, angle_error)
+
+    bones = [BoneError(decode_name(names[i]), int(keys[i]), float(max_location[i]), float(max_angle[i])) for i in range(len(names)) if keys[i] > 0]
+    only_a = len(a) - len(index_a)
+    only_b = len(b) - len(numpy.unique(index_b))
+    return Comparison(bones, only_a, only_b)
+
+def compare_files(path_a, path_b):
+    with VmdFile(path_a) as file_a, VmdFile(path_b) as file_b:
+        result = compare(file_a.bones, file_b.bones)
+    return result
+
+# python から: reader.main(["a.vmd", "b.vmd"])
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) != 2:
+        print("usage : a.vmd b.vmd")
+        return 2
+
+    result = compare_files(args[0], args[1])
+    print(result)
+    return 0 if result.only_a == 0 and result.only_b == 0 else 1
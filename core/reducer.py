@@ -0,0 +1,245 @@
+import math
+import numpy
+from . import encoder
+
+# 1 ボーン分のベイク済みキーフレーム (VMD の座標系)
+class Track():
+    def __init__(self):
+        self.frames = []
+        self.locations = []
+        self.quaternions = []
+
+    def __len__(self):
+        return len(self.frames)
+
+    def append(self, frame, location, quaternion):
+        # 補間しやすいように前のフレームと同じ半球にそろえる
+        if self.quaternions:
+            prev = self.quaternions[-1]
+            if quaternion_dot(prev, quaternion) < 0.0:
+                quaternion = tuple(-v for v in quaternion)
+
+        self.frames.append(frame)
+        self.locations.append(tuple(location))
+        self.quaternions.append(tuple(quaternion))
+
+class ReductionStats():
+    def __init__(self):
+        self.input_count = 0
+        self.output_count = 0
+        self.max_location_error = 0.0
+        self.max_angle_error = 0.0
+
+    @property
+    def ratio(self):
+        if self.output_count <= 0:
+            return 0.0
+        return self.input_count / self.output_count
+
+    def __str__(self):
+        return "keys : {0} -> {1} (x{2:.2f}), max location error : {3:.6f}, max angle error : {4:.4f} deg".format(
+            self.input_count, self.output_count, self.ratio, self.max_location_error, math.degrees(self.max_angle_error))
+
+# フレーム順に並んだ値 (フレーム数, チャンネル数) のうち、残すキーフレームを True にした配列を返す
+# 同じ値が続く区間は最初と最後だけを残すので、線形補間で同じ値になる
+def keep_changes(values):
+    keep = numpy.ones(values.shape, dtype=bool)
+    same = values[1:] == values[:-1]
+    keep[1:-1] = ~(same[:-1] & same[1:])
+    return keep
+
+# 許容誤差内で補間曲線にフィットさせ、必要なキーフレームだけを残す
+# 戻り値は (Track のインデックス, 補間データ) のリスト
+def reduce_track(track, location_tolerance, angle_tolerance, stats=None):
+    size = len(track)
+    if size <= 0:
+        return []
+
+    keys = [(0, encoder.LINEAR_IPO)]
+    start = 0
+    while start < size - 1:
+        end, ipo, location_error, angle_error = extend_segment(track, start, location_tolerance, angle_tolerance)
+        keys.append((end, ipo))
+
+        if stats is not None:
+            stats.max_location_error = max(stats.max_location_error, location_error)
+            stats.max_angle_error = max(stats.max_angle_error, angle_error)
+        start = end
+
+    if stats is not None:
+        stats.input_count += size
+        stats.output_count += len(keys)
+
+    return keys
+
+# start から伸ばせるだけ区間を伸ばす (倍々に探してから二分探索)
+def extend_segment(track, start, location_tolerance, angle_tolerance):
+    last = len(track) - 1
+
+    best = (start + 1,) + fit_segment(track, start, start + 1)
+    step = 2
+    low = start + 1
+    high = None
+    while True:
+        end = min(start + step, last)
+        if end <= low:
+            break
+        result = fit_segment(track, start, end)
+        if result[1] <= location_tolerance and result[2] <= angle_tolerance:
+            best = (end,) + result
+            low = end
+            if end == last:
+                break
+            step *= 2
+        else:
+            high = end
+            break
+
+    while high is not None and high - low > 1:
+        end = (low + high) // 2
+        result = fit_segment(track, start, end)
+        if result[1] <= location_tolerance and result[2] <= angle_tolerance:
+            best = (end,) + result
+            low = end
+        else:
+            high = end
+
+    return best
+
+# start から end までの区間を補間曲線で近似し、(補間データ, 位置の最大誤差, 角度の最大誤差) を返す
+def fit_segment(track, start, end):
+    curves = fit_curves(track, start, end)
+    location_error, angle_error = segment_error(track, start, end, curves)
+    return encoder.build_ipo(*curves), location_error, angle_error
+
+# X, Y, Z, 回転 の補間曲線を求める
+def fit_curves(track, start, end):
+    locations = track.locations
+    quaternions = track.quaternions
+
+    times = segment_times(track, start, end)
+
+    curves = []
+    for axis in range(3):
+        begin = locations[start][axis]
+        delta = locations[end][axis] - begin
+        if abs(delta) <= 1e-9:
+            curves.append(encoder.LINEAR_CURVE)
+            continue
+        progress = [(locations[k][axis] - begin) / delta for k in range(start + 1, end)]
+        curves.append(fit_curve(times, progress))
+
+    q_start = quaternions[start]
+    q_end = quaternions[end]
+    theta = quaternion_angle(q_start, q_end)
+    if theta <= 1e-9:
+        curves.append(encoder.LINEAR_CURVE)
+    else:
+        progress = [quaternion_angle(q_start, quaternions[k]) / theta for k in range(start + 1, end)]
+        curves.append(fit_curve(times, progress))
+
+    return curves
+
+# 補間曲線で補間したときの (位置の最大誤差, 角度の最大誤差) を返す
+def segment_error(track, start, end, curves):
+    locations = track.locations
+    quaternions = track.quaternions
+
+    times = segment_times(track, start, end)
+    q_start = quaternions[start]
+    q_end = quaternions[end]
+
+    location_error = 0.0
+    angle_error = 0.0
+    for n, k in enumerate(range(start + 1, end)):
+        t = times[n]
+        location = [locations[start][axis] + (locations[end][axis] - locations[start][axis]) * bezier_value(curves[axis], t) for axis in range(3)]
+        location_error = max(location_error, math.sqrt(sum((location[axis] - locations[k][axis]) ** 2 for axis in range(3))))
+
+        quaternion = quaternion_slerp(q_start, q_end, bezier_value(curves[3], t))
+        angle_error = max(angle_error, quaternion_angle(quaternion, quaternions[k]))
+
+    return location_error, angle_error
+
+def segment_times(track, start, end):
+    frames = track.frames
+    duration = frames[end] - frames[start]
+    return [(frames[k] - frames[start]) / duration for k in range(start + 1, end)]
+
+# x1 = 1/3, x2 = 2/3 に固定し、y1, y2 を最小二乗法で求める
+def fit_curve(times, progress):
+    a11 = a12 = a22 = b1 = b2 = 0.0
+    for t, p in zip(times, progress):
+        u = 1.0 - t
+        c1 = 3.0 * u * u * t
+        c2 = 3.0 * u * t * t
+        r = p - t * t * t
+        a11 += c1 * c1
+        a12 += c1 * c2
+        a22 += c2 * c2
+        b1 += c1 * r
+        b2 += c2 * r
+
+    det = a11 * a22 - a12 * a12
+    if abs(det) <= 1e-12:
+        if a11 <= 1e-12:
+            return encoder.LINEAR_CURVE
+        # 1 点しかない場合は y1 = y2 として解く
+        y = (b1 + b2) / (a11 + 2.0 * a12 + a22)
+        y1 = y2 = y
+    else:
+        y1 = (b1 * a22 - b2 * a12) / det
+        y2 = (a11 * b2 - a12 * b1) / det
+
+    return (42, quantize(y1), 85, quantize(y2))
+
+def quantize(value):
+    return min(max(int(round(value * 127.0)), 0), 127)
+
+# MMD と同じく x から媒介変数を求め、y を返す
+def bezier_value(curve, x):
+    x1 = curve[0] / 127.0
+    y1 = curve[1] / 127.0
+    x2 = curve[2] / 127.0
+    y2 = curve[3] / 127.0
+
+    low = 0.0
+    high = 1.0
+    s = x
+    for i in range(32):
+        u = 1.0 - s
+        value = 3.0 * u * u * s * x1 + 3.0 * u * s * s * x2 + s * s * s
+        if abs(value - x) <= 1e-6:
+            break
+        if value < x:
+            low = s
+        else:
+            high = s
+        s = (low + high) * 0.5
+
+    u = 1.0 - s
+    return 3.0 * u * u * s * y1 + 3.0 * u * s * s * y2 + s * s * s
+
+def quaternion_dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2] + a[3] * b[3]
+
+def quaternion_angle(a, b):
+    dot = min(abs(quaternion_dot(a, b)), 1.0)
+    return 2.0 * math.acos(dot)
+
+def quaternion_slerp(a, b, t):
+    dot = quaternion_dot(a, b)
+    if dot < 0.0:
+        b = tuple(-v for v in b)
+        dot = -dot
+
+    if dot > 0.9995:
+        result = [a[i] + (b[i] - a[i]) * t for i in range(4)]
+        length = math.sqrt(sum(v * v for v in result))
+        return tuple(v / length for v in result)
+
+    theta = math.acos(dot)
+    sin_theta = math.sin(theta)
+    wa = math.sin((1.0 - t) * theta) / sin_theta
+    wb = math.sin(t * theta) / sin_theta
+    return tuple(wa * a[i] + wb * b[i] for i in range(4))
@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import mmap
+import numpy
+import os
+import sys
+import tempfile
+from . import encoder, writer
+
+# 複数の VMD ファイルを 1 つにまとめる (ショットごとに出力したモーションの結合)
+#
+# 各ファイルはメモリマップで開き、キーフレームはデコードせずにレコードの範囲ごとにコピーする
+# フレームオフセットがある場合だけ、ブロックごとにフレーム番号を書き換える
+# セクションごとに、後のファイルのフレーム範囲 (そのセクションの最初から最後のキーフレームまで) と重なる前のファイルのキーフレームは捨てる
+# (後のファイルにないセクション、例えばカメラだけのファイルのボーンは残す)
+#
+# python -m vmd_exporter.core.splice out.vmd shot1.vmd shot2.vmd --offsets 0 240
+
+# フレーム番号を書き換える場合に 1 回でコピーするレコード数
+BLOCK_RECORDS = 65536
+
+# セクションの順 (IK はレコードの長さが可変なので別に扱う)
+FIXED_SECTIONS = (
+    ("bone", encoder.BONE_RECORD_DTYPE),
+    ("morph", encoder.MORPH_RECORD_DTYPE),
+    ("camera", encoder.CAMERA_RECORD_DTYPE),
+    ("light", encoder.LIGHT_RECORD_DTYPE),
+    ("self_shadow", encoder.SELF_SHADOW_RECORD_DTYPE))
+SECTION_NAMES = tuple(name for name, dtype in FIXED_SECTIONS) + ("ik",)
+
+# IK キーフレーム: フレーム番号(4) 表示(1) IK 数(4) と IK ごとに 名前(20) on/off(1)
+IK_HEADER_SIZE = 9
+IK_ENTRY_SIZE = 21
+
+MAX_FRAME = 0xFFFFFFFF
+
+# メモリマップで開いた VMD ファイルのセクションの位置
+# 古い形式で後ろのセクションがない場合は 0 件として扱う
+class VmdSections():
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        try:
+            self.read_sections()
+        except Exception:
+            self.close()
+            raise
+
+    def read_sections(self):
+        buffer = self.mmap
+        meta = bytes(buffer[:30])
+        name_size = 20 if meta.startswith(encoder.META.encode("shift_jis")) else 10
+        self.model_name = bytes(buffer[30:30 + name_size]).split(b"\0", 1)[0]
+
+        offset = 30 + name_size
+        if len(buffer) < offset + encoder.UINT32.size:
+            raise ValueError("not a VMD file : " + self.path)
+
+        # セクション名 -> 構造化配列のビュー
+        self.records = {}
+        for name, dtype in FIXED_SECTIONS:
+            count, offset = self.read_count(offset)
+            if len(buffer) < offset + count * dtype.itemsize:
+                raise ValueError("truncated " + name + " keyframes : " + self.path)
+            self.records[name] = numpy.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+            offset += count * dtype.itemsize
+
+        # IK は (開始位置, 長さ) のリスト
+        count, offset = self.read_count(offset)
+        self.ik_ranges = []
+        for i in range(count):
+            if len(buffer) < offset + IK_HEADER_SIZE:
+                raise ValueError("truncated ik keyframes : " + self.path)
+            size = IK_HEADER_SIZE + encoder.UINT32.unpack_from(buffer, offset + 5)[0] * IK_ENTRY_SIZE
+            if len(buffer) < offset + size:
+                raise ValueError("truncated ik keyframes : " + self.path)
+            self.ik_ranges.append((offset, size))
+            offset += size
+        self.ik_frames = numpy.array([encoder.UINT32.unpack_from(buffer, start)[0] for start, size in self.ik_ranges], dtype=numpy.int64)
+
+    def read_count(self, offset):
+        if len(self.mmap) < offset + encoder.UINT32.size:
+            return 0, offset
+        return encoder.UINT32.unpack_from(self.mmap, offset)[0], offset + encoder.UINT32.size
+
+    def frames(self, name):
+        if name == "ik":
+            return self.ik_frames
+        return self.records[name]["frame"].astype(numpy.int64)
+
+    # セクションの (最初, 最後) のフレーム (キーフレームがない場合は None)
+    def frame_range(self, name):
+        frames = self.frames(name)
+        if len(frames) <= 0:
+            return None
+        return int(frames.min()), int(frames.max())
+
+    def close(self):
+        self.records = None
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class SpliceStats():
+    def __init__(self):
+        # セクション名 -> 出力したキーフレーム数
+        self.counts = {name: 0 for name in SECTION_NAMES}
+        # 後のファイルと重なって捨てたキーフレーム数
+        self.overlapped = 0
+        # オフセットを足してフレーム番号が範囲外になったキーフレーム数
+        self.out_of_range = 0
+
+    def __str__(self):
+        return "{0} : overlapped {1}, out of range {2}".format(
+            ", ".join("{0} {1}".format(name, self.counts[name]) for name in SECTION_NAMES), self.overlapped, self.out_of_range)
+
+# inputs は (パス, フレームオフセット) のリスト (後のものほど優先)
+# model_name を省略すると最初のファイルのモデル名を使う
+def splice(inputs, output_path, model_name=None):
+    stats = SpliceStats()
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(VmdSections(path)) for path, offset in inputs]
+        offsets = [int(offset) for path, offset in inputs]
+
+        # セクション名 -> ファイルごとの残すレコードのマスク
+        masks = {}
+        for name in SECTION_NAMES:
+            masks[name] = []
+            ranges = []
+            for file, offset in zip(files, offsets):
+                frame_range = file.frame_range(name)
+                ranges.append(None if frame_range is None else (frame_range[0] + offset, frame_range[1] + offset))
+            for i, (file, offset) in enumerate(zip(files, offsets)):
+                frames = file.frames(name) + offset
+                keep = (frames >= 0) & (frames <= MAX_FRAME)
+                stats.out_of_range += len(keep) - int(numpy.count_nonzero(keep))
+                for later in ranges[i + 1:]:
+                    if later is None:
+                        continue
+                    overlapped = keep & (frames >= later[0]) & (frames <= later[1])
+                    stats.overlapped += int(numpy.count_nonzero(overlapped))
+                    keep &= ~overlapped
+                masks[name].append(keep)
+                stats.counts[name] += int(numpy.count_nonzero(keep))
+
+        if model_name is None:
+            model_name = files[0].model_name if files else ""
+
+        # 入力と同じファイルに出力できるように、一時ファイルに書いてから置き換える
+        directory = os.path.dirname(os.path.abspath(output_path))
+        handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(handle, "wb") as output:
+                writer.write_header(output, model_name)
+                for name, dtype in FIXED_SECTIONS:
+                    output.write(encoder.UINT32.pack(stats.counts[name]))
+                    for file, offset, keep in zip(files, offsets, masks[name]):
+                        copy_records(output, file.records[name], keep, offset)
+                output.write(encoder.UINT32.pack(stats.counts["ik"]))
+                for file, offset, keep in zip(files, offsets, masks["ik"]):
+                    copy_ik_records(output, file, keep, offset)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    os.replace(temp_path, output_path)
+    return stats
+
+# keep が連続して True の範囲ごとにレコードをコピーする
+def copy_records(output, records, keep, offset):
+    if len(records) == 0:
+        return
+    for start, end in true_runs(keep):
+        for block_start in range(start, end, BLOCK_RECORDS):
+            block_end = min(block_start + BLOCK_RECORDS, end)
+            if offset == 0:
+                output.write(records[block_start:block_end].data)
+            else:
+                block = records[block_start:block_end].copy()
+                block["frame"] = block["frame"].astype(numpy.int64) + offset
+                output.write(block.data)
+
+def copy_ik_records(output, file, keep, offset):
+    for (start, size), kept in zip(file.ik_ranges, keep):
+        if not kept:
+            continue
+        frame = encoder.UINT32.unpack_from(file.mmap, start)[0] + offset
+        output.write(encoder.UINT32.pack(frame))
+        output.write(file.mmap[start + encoder.UINT32.size:start + size])
+
+# (開始, 終了) のリスト
+def true_runs(mask):
+    edges = numpy.diff(numpy.concatenate([[0], mask.view(numpy.int8), [0]]))
+    starts = numpy.nonzero(edges == 1)[0]
+    ends = numpy.nonzero(edges == -1)[0]
+    return zip(starts.tolist(), ends.tolist())
+
+# python から: splice.main(["out.vmd", "a.vmd", "b.vmd", "--offsets", "0", "240"])
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Combine VMD files (later files win where frames overlap)")
+    parser.add_argument("output")
+    parser.add_argument("inputs", nargs="+")
+    parser.add_argument("--offsets", type=int, nargs="+", default=[], help="frame offset of each input (missing offsets are 0)")
+    parser.add_argument("--model-name", default=None)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if len(args.offsets) > len(args.inputs):
+        parser.error("more offsets than inputs")
+    offsets = args.offsets + [0] * (len(args.inputs) - len(args.offsets))
+
+    stats = splice(list(zip(args.inputs, offsets)), args.output, args.model_name)
+    print(stats)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
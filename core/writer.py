@@ -0,0 +1,86 @@
+import contextlib
+import numpy
+import os
+from . import encoder
+
+# 名前、フレーム番号、位置、回転の配列から VMD を書き出す
+# 位置と回転は VMD の座標系 (位置 (x, y, z), 回転 (x, y, z, w))
+
+# 固定長の Shift-JIS のバイト列にする (長い場合は 2 byte 文字の途中で切らないように切り詰め、残りは 0 で埋める)
+def encode_name(name, size):
+    data = name.encode("shift_jis") if isinstance(name, str) else bytes(name)
+    if len(data) > size:
+        data = data[:size]
+        while data and not is_shift_jis(data):
+            data = data[:-1]
+    return data.ljust(size, b"\0")
+
+def is_shift_jis(data):
+    try:
+        data.decode("shift_jis")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+# ボーンキーフレームの構造化配列を作る
+# names, frames は (N,), locations は (N, 3), quaternions は (N, 4)
+# ipo は 64 byte の補間データ 1 つ、または (N, 64) の配列
+def bone_records(names, frames, locations, quaternions, ipo=encoder.LINEAR_IPO):
+    records = numpy.zeros(len(names), dtype=encoder.BONE_RECORD_DTYPE)
+    records["name"] = [encode_name(name, 15) for name in names]
+    records["frame"] = frames
+    records["location"] = locations
+    records["quaternion"] = quaternions
+    if isinstance(ipo, (bytes, bytearray)):
+        ipo = numpy.frombuffer(ipo, dtype=numpy.uint8)
+    records["ipo"] = ipo
+    return records
+
+# 表情キーフレームの構造化配列を作る
+def morph_records(names, frames, weights):
+    records = numpy.zeros(len(names), dtype=encoder.MORPH_RECORD_DTYPE)
+    records["name"] = [encode_name(name, 15) for name in names]
+    records["frame"] = frames
+    records["weight"] = weights
+    return records
+
+def write_header(file, model_name):
+    file.write(encode_name(encoder.META, 30))
+    file.write(encode_name(model_name, 20))
+
+# キーフレーム数とキーフレームを書く (records が None の場合は 0 件)
+def write_section(file, records):
+    if records is None:
+        file.write(encoder.UINT32.pack(0))
+        return
+    file.write(encoder.UINT32.pack(len(records)))
+    file.write(records.tobytes())
+
+# 出力しないセルフ影と IK のセクション
+def write_unused_sections(file):
+    file.write(encoder.UINT32.pack(0)) # セルフ影キーフレーム数
+    file.write(encoder.UINT32.pack(0)) # モデル表示・IK on/offキーフレーム数
+
+# path.tmp に書き、最後まで書けた場合だけディスクに書き出してから path に置き換える
+# 途中で失敗した場合は一時ファイルを消し、既存の path はそのまま残す
+@contextlib.contextmanager
+def atomic_file(path):
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# 各セクションは encoder の *_RECORD_DTYPE の配列 (None は 0 件)
+def write_vmd(file, model_name, bones=None, morphs=None, cameras=None, lights=None):
+    write_header(file, model_name)
+    write_section(file, bones)
+    write_section(file, morphs)
+    write_section(file, cameras)
+    write_section(file, lights)
+    write_unused_sections(file)
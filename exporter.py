@@ -1,19 +1,40 @@
 import bpy
 import collections
 import configparser
+import cProfile
 import datetime
 import mathutils
+import numpy
 import os
-import struct
 import logging
-from . import const
+import string
+import time
+from . import cache, camera, const, fk, keyframes, morph, pipeline, sampler, timing
+from . core import compactor, encoder, reducer, writer
 
 logger = logging.getLogger(const.ADDON_NAME)
 
-class VmdExporter(bpy.types.Operator):
-    bl_idname = "vmd.exporter"
-    bl_label = "Export VMD"
+# エクスポート中に変わらないボーンのデータ
+class BoneEntry():
+    __slots__ = ("pose_bone", "parent", "name", "rest_inverted", "parent_rest_inverted", "offset")
 
+    def __init__(self, pose_bone, parent, name):
+        self.pose_bone = pose_bone
+        self.parent = parent
+        self.name = name
+
+        matrix_local = pose_bone.bone.matrix_local
+        self.rest_inverted = matrix_local.inverted()
+
+        if parent is None:
+            self.parent_rest_inverted = None
+            self.offset = matrix_local.to_translation()
+        else:
+            self.parent_rest_inverted = parent.bone.matrix_local.inverted()
+            self.offset = (self.parent_rest_inverted * matrix_local).to_translation() * self.parent_rest_inverted
+
+# UI のコンテキストに依存しないエクスポート処理
+class Exporter():
     # vmd data prop
     ipo_list = []
 
@@ -23,57 +44,293 @@ class VmdExporter(bpy.types.Operator):
     # log text
     log = []
 
-    def __init__(self):
-        self.scene = bpy.context.scene
+    def __init__(self, scene, obj):
+        self.scene = scene
         self.timeline_markers = self.scene.timeline_markers
-        self.obj = bpy.context.object
-        self.arm = bpy.context.armature
+        self.obj = obj
+        self.arm = obj.data
         self.pose = self.obj.pose
 
         self.export_bones = [self.pose.bones[bone.name] for bone in self.arm.bones if bone.vmd_bone_properties.export]
+        self.bone_table = []
 
         vmd_armature_properties = self.arm.vmd_armature_properties
 
         self.use_marker_mode = vmd_armature_properties.use_marker_mode
-        self.frame_start = vmd_armature_properties.frame_start
-        self.frame_end = vmd_armature_properties.frame_end
-        if vmd_armature_properties.use_marker_mode:
-            self.marker_frames = [marker.frame for marker in self.timeline_markers if (self.frame_start <= marker.frame and marker.frame <= self.frame_end)]
-            self.frame_size = len(marker_frames)
-        else:
-            self.frame_size = self.frame_end - self.frame_start + 1
+        self.use_fcurve_frames = vmd_armature_properties.use_fcurve_frames
+        self.use_frame_selection = self.use_marker_mode or self.use_fcurve_frames
+        self.set_frame_range(vmd_armature_properties.frame_start, vmd_armature_properties.frame_end)
 
         self.frame_offset = vmd_armature_properties.frame_offset
         self.scale = vmd_armature_properties.scale
 
+        self.use_keyframes = vmd_armature_properties.use_keyframes
+        self.use_reduction = vmd_armature_properties.use_reduction
+        self.reduction_location_tolerance = vmd_armature_properties.reduction_location_tolerance
+        self.reduction_angle_tolerance = vmd_armature_properties.reduction_angle_tolerance
+        self.reduction_stats = None
+        self.use_compaction = vmd_armature_properties.use_compaction
+        self.compaction_stats = None
+
+        morph_object = vmd_armature_properties.morph_object
+        # シェイプキーがない場合は check_morph_names で報告する
+        self.morph_object = morph_object if morph_object and morph_object.type == 'MESH' else None
+        camera_object = vmd_armature_properties.camera_object
+        self.camera_object = camera_object if camera_object and camera_object.type == 'CAMERA' else None
+        light_object = vmd_armature_properties.light_object
+        self.light_object = light_object if light_object and light_object.type == 'LAMP' else None
+
+        # ボーンと同じフレームで値を読むもの (表情、カメラ、照明)
+        self.morph_sampler = None
+        self.camera_sampler = None
+        self.light_sampler = None
+        self.frame_samplers = []
+
+        # frame_set を呼ばずにアクションからポーズを計算する (できない場合は frame_set)
+        self.use_native_pose = vmd_armature_properties.use_native_pose
+        self.verify_native_pose = vmd_armature_properties.verify_native_pose
+        self.pose_evaluator = None
+        self.pose_verification = None
+
+        self.use_background_writer = vmd_armature_properties.use_background_writer
+        self.write_queue_size = vmd_armature_properties.write_queue_size
+
+        self.use_cache = vmd_armature_properties.use_cache
+        self.cache_size = vmd_armature_properties.cache_size
+
+        # True の場合は frame_set を呼ばず、yield したフレームに呼び出し側が合わせる (multi)
+        self.shared_frames = False
+
+        # 段階ごとの時間 (export_steps を始めるたびに作り直す)
+        self.stage_timer = timing.StageTimer()
+        self.use_profile = vmd_armature_properties.use_profile
+
         self.export_folder = bpy.path.abspath(vmd_armature_properties.export_folder)
         self.file_name = vmd_armature_properties.file_name
+        # 設定されている場合は export_folder, file_name の代わりに使う
+        self.output_path = None
+        self.exported = False
+        # 出力前の確認で見つかった問題 (1 つでもあれば出力しない)
+        self.errors = []
 
         # TODO: 謎のプロパティ
         self.joint_opt = False
 
-    def invoke(self, context, event):
-        self.export_vmd()
-
-        return {"FINISHED"}
-
+    def set_frame_range(self, frame_start, frame_end):
+        self.frame_start = frame_start
+        self.frame_end = frame_end
+        self.frames = self.select_frames()
+        self.frame_size = len(self.frames)
+
+    # 評価するフレームを昇順で重複なく選ぶ
+    # マーカーとキーフレームのどちらも使わない場合は範囲内の全てのフレーム
+    def select_frames(self):
+        if not self.use_frame_selection:
+            return list(range(self.frame_start, self.frame_end + 1))
+
+        frames = set()
+        if self.use_marker_mode:
+            frames.update(marker.frame for marker in self.timeline_markers)
+        if self.use_fcurve_frames:
+            frames.update(self.fcurve_frames())
+
+        frames = sorted(frame for frame in frames if self.frame_start <= frame <= self.frame_end)
+        logger.debug("selected frames : " + str(len(frames)))
+        return frames
+
+    # 出力するボーンとその親のキーフレームがあるフレーム
+    def fcurve_frames(self):
+        animation_data = self.obj.animation_data
+        if animation_data is None or animation_data.action is None:
+            return []
+
+        bone_paths = set()
+        for bone in self.export_bones:
+            parents = [bone] + bone.parent_recursive
+            mmd_parent = bone.bone.vmd_bone_properties.mmd_parent
+            if mmd_parent in self.pose.bones:
+                mmd_parent = self.pose.bones[mmd_parent]
+                parents += [mmd_parent] + mmd_parent.parent_recursive
+            bone_paths.update(parent.path_from_id() for parent in parents)
+
+        frames = set()
+        for fcurve in animation_data.action.fcurves:
+            if fcurve.data_path.rsplit(".", 1)[0] not in bone_paths:
+                continue
+            frames.update(int(round(keyframe.co[0])) for keyframe in fcurve.keyframe_points)
+        return frames
+
+    # 出力できた場合は True を返す
     def export_vmd(self):
+        for step in self.export_steps():
+            pass
+        return self.exported
+
+    # フレームを評価する前にそのフレームを yield する (キャッシュから書くフレームは None)
+    # use_profile の場合は cProfile の結果を VMD ファイルの隣 (.prof) に書き出す
+    def export_steps(self):
+        self.stage_timer = timing.StageTimer()
+        if not self.use_profile:
+            yield from self.write_steps()
+            return
+
+        profile = cProfile.Profile()
+        yield from timing.profile_steps(self.write_steps(), profile)
+        if self.exported:
+            profile.dump_stats(self.path + ".prof")
+            logger.info("profile : " + self.path + ".prof")
+
+    # 一時ファイルに書き出し、最後まで書けた場合だけ置き換える
+    def write_steps(self):
         if self.check_data() is False: return
+        self.prepare()
+
+        with writer.atomic_file(self.path) as raw_file:
+            file = timing.TimedFile(raw_file, self.stage_timer)
+            if self.use_background_writer:
+                yield from self.write_in_background(file)
+            else:
+                yield from self.write_sections(file)
+        self.exported = True
+
+        self.stage_timer.finish(self.frame_size)
+        for line in self.stage_timer.lines():
+            logger.info(line)
+
+        if self.pose_verification is not None:
+            if self.pose_verification.passed:
+                logger.info(str(self.pose_verification))
+            else:
+                logger.warning(str(self.pose_verification))
+
+    def write_sections(self, file):
+        self.write_header(file)
+        yield from self.export_all_bone_data(file)
+        yield from self.complete_frames()
+        self.write_counts(file)
+
+    # 書き込みを別スレッドに任せる (キューがいっぱいの場合だけ待つ)
+    # 書き込みのエラーはここで送出され、途中で終わった場合は残りを捨てる
+    def write_in_background(self, file):
+        background_writer = pipeline.BackgroundWriter(file, self.write_queue_size)
+        try:
+            yield from self.write_sections(background_writer)
+            background_writer.close()
+        finally:
+            background_writer.abort()
+        self.stage_timer.add("write_wait", background_writer.wait_seconds, background_writer.wait_count)
+
+    def prepare(self):
         self.init_ipo_list()
+        self.ipo = bytes(self.ipo_list)
         self.init_path()
-
-        with open(self.path, "wb") as file:
-            self.write_str(file, 30, const.META)
-            self.write_str(file, 20, self.arm.name)
-            self.export_all_bone_data(file)
-            self.write_long(file, 0) # 表情キーフレーム数
-            self.write_long(file, 0) # カメラキーフレーム数
-            self.write_long(file, 0) # 照明キーフレーム数
-            self.write_long(file, 0) # セルフ影キーフレーム数
-            self.write_long(file, 0) # モデル表示・IK on/offキーフレーム数
-
+        self.init_bone_table()
+        if self.morph_object:
+            self.morph_sampler = morph.MorphSampler(self.morph_object)
+        if self.camera_object:
+            self.camera_sampler = camera.CameraSampler(self.camera_object, self.scene, self.scale)
+        if self.light_object:
+            self.light_sampler = camera.LightSampler(self.light_object)
+        self.frame_samplers = [frame_sampler for frame_sampler in (self.morph_sampler, self.camera_sampler, self.light_sampler) if frame_sampler is not None]
+        if self.use_native_pose:
+            self.init_pose_evaluator()
+
+    def init_pose_evaluator(self):
+        # 表情、カメラ、照明はシーンを評価しないと読めない
+        if self.frame_samplers:
+            logger.info("native pose : disabled (morph, camera or light needs frame_set)")
+            return
+
+        bones = [entry.pose_bone for entry in self.bone_table] + [entry.parent for entry in self.bone_table if entry.parent is not None]
+        evaluator = fk.ArmatureEvaluator(self.obj, bones, self.frames)
+        if evaluator.unsupported:
+            for name, reason in sorted(evaluator.unsupported.items()):
+                logger.info("native pose : frame_set for " + name + " (" + reason + ")")
+            return
+
+        self.pose_evaluator = evaluator
+        logger.info("native pose : " + str(len(evaluator.order)) + " bones")
+
+        if self.verify_native_pose:
+            names = sorted(set(bone.name for bone in bones))
+            self.pose_verification = fk.Verification(names, [evaluator.index_map[name] for name in names])
+
+    def write_header(self, file):
+        writer.write_header(file, self.arm.name)
+
+    # ボーン以降のセクション
+    def write_counts(self, file):
+        self.write_records(file, "morph", self.morph_sampler) # 表情
+        self.write_records(file, "camera", self.camera_sampler) # カメラ
+        self.write_records(file, "light", self.light_sampler) # 照明
+        writer.write_unused_sections(file)
+
+    # frame_set が必要な場合は frame を、ポーズを計算する場合は None を返す (yield する値)
+    def frame_request(self, frame):
+        if self.pose_evaluator is not None and self.pose_verification is None:
+            return None
+        return frame
+
+    # フレームを評価する (表情、カメラ、照明もここで読む)
+    def evaluate_frame(self, frame):
+        if not self.shared_frames and self.frame_request(frame) is not None:
+            with self.stage_timer.stage("frame_set"):
+                self.scene.frame_set(frame)
+        if self.frame_samplers:
+            with self.stage_timer.stage("sample"):
+                for frame_sampler in self.frame_samplers:
+                    frame_sampler.sample(frame)
+
+    # ボーンの出力で評価しなかったフレームの表情、カメラ、照明を読む
+    def complete_frames(self):
+        frames = set()
+        for frame_sampler in self.frame_samplers:
+            frames.update(frame_sampler.missing_frames(self.frames))
+        if frames:
+            logger.info("remaining frames : " + str(len(frames)))
+
+        for i in sorted(frames):
+            yield i
+            self.evaluate_frame(i)
+
+    # キーフレーム数とキーフレームを書く (frame_sampler がない場合は 0 件)
+    def write_records(self, file, name, frame_sampler):
+        if frame_sampler is None:
+            writer.write_section(file, None)
+            return
+
+        with self.stage_timer.stage("pack"):
+            records = frame_sampler.records(self.frame_offset)
+        logger.info(name + " keys : " + str(len(records)))
+        writer.write_section(file, records)
+
+    # 評価するフレームのリスト
+    def export_frames(self):
+        return self.frames
+
+    def cache_path(self):
+        return self.path + ".cache"
+
+    # 複数プロセスに分けられない設定 (分けられる場合は None)
+    def shard_reason(self):
+        if self.use_keyframes and not self.use_frame_selection:
+            return "keyframes only"
+        if self.use_reduction or self.use_compaction:
+            return "key reduction"
+        if self.morph_object or self.camera_object or self.light_object:
+            return "morph, camera or light"
+        if self.use_cache:
+            return "incremental export"
+        if self.use_background_writer:
+            return "background writer"
+        if self.use_profile:
+            return "profile"
+        return None
+
+    # フレームを評価する前に、途中で失敗する原因になる設定をまとめて確認する
     def check_data(self):
         logger.info("start")
+        self.errors = []
 
         if len(self.export_bones) <= 0:
             logger.info("export bone size : " + str(len(self.export_bones)))
@@ -83,34 +340,133 @@ class VmdExporter(bpy.types.Operator):
             logger.info("export frame size : " + str(self.frame_size))
             return False
 
-        if not self.export_folder:
-            logger.error("export folder does not exist.")
-            return False
-        logger.debug("export folder : " + self.export_folder)
+        if self.output_path:
+            logger.debug("output path : " + self.output_path)
+        elif not self.export_folder:
+            self.errors.append("export folder does not exist.")
+        elif not self.file_name:
+            self.errors.append("file name does not exist.")
+        else:
+            logger.debug("export folder : " + self.export_folder)
+            logger.debug("file name : " + self.file_name)
 
-        if not self.file_name:
-            logger.error("file name does not exist.")
+        if not self.errors:
+            self.init_path()
+            self.check_output_path()
+        self.check_bone_names()
+        self.check_parents()
+        self.check_morph_names()
+        self.check_camera_distance()
+
+        for error in self.errors:
+            logger.error(error)
+        if self.errors:
             return False
-        logger.debug("file name : " + self.file_name)
 
         logger.info("end")
 
+    # 一時ファイルを作れるか実際に試す
+    def check_output_path(self):
+        if os.path.isdir(self.path):
+            self.errors.append("output path is a folder : " + self.path)
+            return
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "wb"):
+                pass
+            os.remove(temp_path)
+        except OSError as e:
+            self.errors.append("can not write output : " + self.path + " (" + str(e) + ")")
+
+    def check_bone_names(self):
+        encoded_names = {}
+        for pose_bone in self.export_bones:
+            bone = pose_bone.bone
+            name = self.bone_name(bone)
+            try:
+                data = name.encode("shift_jis")
+            except UnicodeEncodeError:
+                self.errors.append("bone name can not be encoded in Shift-JIS : " + name + " (" + bone.name + ")")
+                continue
+            if len(data) > 15:
+                self.errors.append("bone name is longer than 15 bytes : " + name + " (" + str(len(data)) + " bytes)")
+                continue
+            if data in encoded_names:
+                self.errors.append("bones have the same MMD name : " + encoded_names[data] + ", " + bone.name)
+            encoded_names[data] = bone.name
+
+            mmd_parent = bone.vmd_bone_properties.mmd_parent
+            if mmd_parent and mmd_parent not in self.pose.bones:
+                logger.warning("MMD parent bone not found : " + mmd_parent + " (" + bone.name + " uses its parent)")
+
+    # MMD 親ボーンをたどって同じボーンに戻る場合はエラー
+    def check_parents(self):
+        # ボーン名 -> たどり始めたボーンの番号 (確認済みは -1)
+        visits = {}
+        for i, pose_bone in enumerate(self.export_bones):
+            path = []
+            current = pose_bone
+            while current is not None and current.name not in visits:
+                visits[current.name] = i
+                path.append(current.name)
+                current = self.find_parent(current)
+            if current is not None and visits[current.name] == i:
+                cycle = path[path.index(current.name):] + [current.name]
+                self.errors.append("MMD parent bones form a cycle : " + " -> ".join(cycle))
+            for name in path:
+                visits[name] = -1
+
+    def check_morph_names(self):
+        if not self.morph_object:
+            return
+        key = self.morph_object.data.shape_keys
+        if key is None:
+            self.errors.append("morph mesh has no shape keys : " + self.morph_object.name)
+            return
+        for key_block in key.key_blocks:
+            if key_block == key.reference_key:
+                continue
+            name = morph.morph_name(self.morph_object.data, key_block)
+            try:
+                data = name.encode("shift_jis")
+            except UnicodeEncodeError:
+                self.errors.append("morph name can not be encoded in Shift-JIS : " + name)
+                continue
+            if len(data) > 15:
+                self.errors.append("morph name is longer than 15 bytes : " + name + " (" + str(len(data)) + " bytes)")
+
+    # ピントの距離もオブジェクトもないと注視点がカメラの位置になる
+    def check_camera_distance(self):
+        if not self.camera_object:
+            return
+        camera = self.camera_object.data
+        if camera.dof_object is None and camera.dof_distance <= 0.0:
+            logger.warning("camera has no focus distance or focus object, target distance is 0 : " + self.camera_object.name)
+
     def init_ipo_list(self):
-        self.ipo_list = [20] * 2
-        self.ipo_list.extend([0] * 2)
-        self.ipo_list.extend([20] * 4)
-        self.ipo_list.extend([107] * 8)
-        self.ipo_list.extend([20] * 7)
-        self.ipo_list.extend([107] * 8)
-        self.ipo_list.extend([0])
-        self.ipo_list.extend([20] * 6)
-        self.ipo_list.extend([107] * 8)
-        self.ipo_list.extend([0] * 2)
-        self.ipo_list.extend([20] * 5)
-        self.ipo_list.extend([107] * 8)
-        self.ipo_list.extend([0] * 3)
+        self.ipo_list = list(encoder.LINEAR_IPO)
+
+    # ボーンごとの親、レストの逆行列、ボーン名を 1 回だけ求める
+    def init_bone_table(self):
+        time_start = time.perf_counter()
+
+        with self.stage_timer.stage("encode_name"):
+            names = [self.encode_bone_name(bone.bone) for bone in self.export_bones]
+        self.bone_table = [BoneEntry(bone, self.find_parent(bone), name) for bone, name in zip(self.export_bones, names)]
+
+        logger.info("bone table : " + str(len(self.bone_table)) + " bones ({0:.3f} sec)".format(time.perf_counter() - time_start))
+
+    def find_parent(self, bone_child):
+        mmd_parent = bone_child.bone.vmd_bone_properties.mmd_parent
+        if mmd_parent in self.pose.bones:
+            return self.pose.bones[mmd_parent]
+        return bone_child.parent
 
     def init_path(self):
+        if self.output_path:
+            self.path = self.output_path
+            return
+
         vmd_armature_properties = self.arm.vmd_armature_properties
 
         if vmd_armature_properties.use_version:
@@ -119,105 +475,207 @@ class VmdExporter(bpy.types.Operator):
             build = vmd_armature_properties.version[2]
             version_map = {"major":major, "minor":minor, "build":build}
 
-            fromat = vmd_armature_properties.version_format
+            version_format = vmd_armature_properties.version_format
 
-            self.file_name += string.Template(fromat).safe_substitute(version_map)
-            logger.debug("file name : " + self.file_name)
+            # check_data と prepare の両方から呼ぶので file_name は変えない
+            file_name = self.file_name + string.Template(version_format).safe_substitute(version_map)
+            logger.debug("file name : " + file_name)
+        else:
+            file_name = self.file_name
 
-        self.path = os.path.join(self.export_folder, self.file_name) + ".pmx"
+        self.path = os.path.join(self.export_folder, file_name) + ".vmd"
 
     def export_all_bone_data(self, file):
         logger.info("start")
 
-        self.write_long(file, self.frame_size * len(self.export_bones))
-
-        # データ出力するボーンをリスト化
-        export_bones_isolated = []
-
-        for i in range(self.frame_start, self.frame_end + 1):
-            if self.use_marker_mode:
-                if i not in self.marker_frames:
-                    logger.debug("skip bone frame : " + str(i))
-                    continue
-
-            self.scene.frame_set(i)
+        if self.use_keyframes and not self.use_frame_selection:
+            yield from self.export_keyframe_bone_data(file)
+            logger.info("end")
+            return
 
-            for bone in self.export_bones:
-                self.export_bone_data(file, i, bone)
+        if self.use_reduction:
+            yield from self.export_reduced_bone_data(file)
+            logger.info("end")
+            return
 
-        logger.info("end")
-
-    def export_bone_data(self, file, frame, bone_child):
+        count_position = file.tell()
+        self.write_long(file, self.frame_size * len(self.bone_table))
 
-        location_local = bone_child.matrix.to_translation()
-        offset = bone_child.bone.matrix_local.to_translation()
-        location_mmd =  location_local - offset
-        quaternion_mmd = (bone_child.matrix * bone_child.bone.matrix_local.inverted()).to_quaternion()
+        record_cache = None
+        if self.use_cache:
+            record_cache = cache.RecordCache(self.cache_path(), self.cache_size * 1024 * 1024)
 
-        vmd_bone_properties = bone_child.bone.vmd_bone_properties
-        bone_parent = None
-        if vmd_bone_properties.mmd_parent in self.arm.bones:
-            bone_parent = self.arm.bones[vmd_bone_properties.mmd_parent]
-        elif bone_child.parent is not None:
-            bone_parent = bone_child.parent
+        # 同じ値が続くキーフレームを除きながら書き、キーフレーム数を後から書き直す
+        bone_file = file
+        if self.use_compaction:
+            self.compaction_stats = compactor.CompactionStats()
+            bone_file = compactor.BoneFrameCompactor(file, self.compaction_stats)
 
-        if bone_parent:
-            location_local = (bone_parent.matrix.inverted() * bone_child.matrix).to_translation() * bone_parent.bone.matrix_local.inverted()
-            offset = (bone_parent.bone.matrix_local.inverted() * bone_child.bone.matrix_local).to_translation() * bone_parent.bone.matrix_local.inverted()
-            location_mmd =  location_local - offset
+        yield from self.write_bone_frames(bone_file, self.export_frames(), record_cache)
 
-            quaternion_parent = (bone_parent.matrix * bone_parent.bone.matrix_local.inverted()).to_quaternion()
-            quaternion_mmd = quaternion_parent.rotation_difference(quaternion_mmd)
+        if self.use_compaction:
+            bone_file.finish()
+            self.rewrite_long(file, count_position, self.compaction_stats.output_count)
+            logger.info(str(self.compaction_stats))
 
-        self.write_bone_data(file, bone_child.bone, frame, location_mmd, quaternion_mmd)
+        if record_cache is not None:
+            record_cache.save()
 
-    def write_bone_data(self, file, bone, frame, vector, quaternion):
-
-        self.write_bone_name(file, bone) # ボーン名
-        self.write_long(file, frame + self.frame_offset) # フレーム番号
-        self.write_location(file, vector)
-        self.write_quaternion(file, quaternion)
-        self.write_ipo(file) # 補間
+        logger.info("end")
 
-    def write_location(self, file, vector):
-        # self.print_all(vector)
-        self.write_float(file, vector.x * self.scale)
-        self.write_float(file, vector.z * self.scale)
-        self.write_float(file, vector.y * self.scale)
+    # ボーン数分のキーフレームをフレームごとに書き出す (キーフレーム数は書かない)
+    # record_cache がある場合は入力が変わっていないフレームを評価せずにキャッシュから書く
+    def write_bone_frames(self, file, frames, record_cache=None):
+        pose_sampler = sampler.PoseSampler(self.pose, self.bone_table, self.scale)
+        fingerprint = cache.Fingerprint(self) if record_cache is not None else None
+
+        # 1 フレーム分のキーフレームをまとめて書き出す
+        records = encoder.bone_record_array([entry.name for entry in self.bone_table], self.ipo)
+
+        for i in frames:
+            data = None
+            if record_cache is not None:
+                key = fingerprint.frame_key(i)
+                data = record_cache.get(key)
+
+            if data is None:
+                yield self.frame_request(i)
+                self.evaluate_frame(i)
+
+                locations, quaternions = self.sample_pose(pose_sampler, i)
+                with self.stage_timer.stage("pack"):
+                    records["frame"] = i + self.frame_offset
+                    records["location"], records["quaternion"] = locations, quaternions
+                    data = records.tobytes()
+
+                if record_cache is not None:
+                    record_cache.put(key, data)
+            else:
+                yield None
+
+            file.write(data)
+
+    # 評価したフレームのボーンの (位置, 回転) を返す
+    def sample_pose(self, pose_sampler, frame):
+        if self.pose_evaluator is None:
+            with self.stage_timer.stage("convert"):
+                return pose_sampler.sample()
+
+        with self.stage_timer.stage("native_pose"):
+            matrices = self.pose_evaluator.frame_matrices(frame)
+        if self.pose_verification is not None:
+            self.pose_verification.compare(frame, matrices, pose_sampler.read_matrices())
+        with self.stage_timer.stage("convert"):
+            return pose_sampler.sample(matrices)
+
+    def export_reduced_bone_data(self, file):
+        tracks = yield from self.bake_tracks(self.bone_table)
+
+        self.reduction_stats = reducer.ReductionStats()
+        with self.stage_timer.stage("reduce"):
+            keys_list = [reducer.reduce_track(track, self.reduction_location_tolerance, self.reduction_angle_tolerance, self.reduction_stats) for track in tracks]
+        logger.info(str(self.reduction_stats))
+
+        self.write_keys(file, self.bone_table, tracks, keys_list)
+
+    # キーフレームのあるフレームだけを出力し、変換できないボーンだけをベイクする
+    def export_keyframe_bone_data(self, file):
+        self.reduction_stats = reducer.ReductionStats()
+
+        sampler = keyframes.KeyframeSampler(self.obj, self.frame_start, self.frame_end, self.convert_location, self.convert_quaternion)
+        with self.stage_timer.stage("keyframes"):
+            results = [sampler.export_bone(entry.pose_bone, self.reduction_location_tolerance, self.reduction_angle_tolerance, self.reduction_stats) for entry in self.bone_table]
+
+        bake_entries = [entry for entry, result in zip(self.bone_table, results) if result is None]
+        logger.info("keyframe bones : " + str(len(self.bone_table) - len(bake_entries)) + ", bake bones : " + str(len(bake_entries)))
+
+        baked_tracks = []
+        if bake_entries:
+            baked_tracks = yield from self.bake_tracks(bake_entries)
+        baked = iter(baked_tracks)
+
+        tracks = []
+        keys_list = []
+        for result in results:
+            if result is not None:
+                track, keys = result
+            else:
+                track = next(baked)
+                if self.use_reduction:
+                    with self.stage_timer.stage("reduce"):
+                        keys = reducer.reduce_track(track, self.reduction_location_tolerance, self.reduction_angle_tolerance, self.reduction_stats)
+                else:
+                    keys = [(index, self.ipo) for index in range(len(track))]
+                    self.reduction_stats.input_count += len(track)
+                    self.reduction_stats.output_count += len(track)
+            tracks.append(track)
+            keys_list.append(keys)
+        logger.info(str(self.reduction_stats))
+
+        self.write_keys(file, self.bone_table, tracks, keys_list)
+
+    # frame_set で各フレームを評価し、ボーンごとの Track を返す
+    def bake_tracks(self, entries):
+        tracks = [reducer.Track() for entry in entries]
+        pose_sampler = sampler.PoseSampler(self.pose, entries, self.scale)
+
+        for i in self.export_frames():
+            yield self.frame_request(i)
+            self.evaluate_frame(i)
+
+            locations, quaternions = self.sample_pose(pose_sampler, i)
+            with self.stage_timer.stage("convert"):
+                for track, location, quaternion in zip(tracks, locations.tolist(), quaternions.tolist()):
+                    track.append(i, location, quaternion)
+
+        return tracks
+
+    def write_keys(self, file, entries, tracks, keys_list):
+        if self.use_compaction:
+            self.compaction_stats = compactor.CompactionStats()
+            keys_list = [self.compact_track_keys(track, keys) for track, keys in zip(tracks, keys_list)]
+            logger.info(str(self.compaction_stats))
+
+        self.write_long(file, sum(len(keys) for keys in keys_list))
+
+        records = encoder.BoneRecordBuffer(len(entries))
+        for entry, track, keys in zip(entries, tracks, keys_list):
+            with self.stage_timer.stage("pack"):
+                for index, ipo in keys:
+                    records.append(entry.name, track.frames[index] + self.frame_offset, track.locations[index], track.quaternions[index], ipo)
+            records.flush(file)
+
+    # 前後と同じ値のキーフレームを除く
+    def compact_track_keys(self, track, keys):
+        if not keys:
+            return keys
+        values = numpy.array([track.locations[index] + track.quaternions[index] for index, ipo in keys], dtype=numpy.float32)
+        keep = compactor.compact_keys(values)
+
+        self.compaction_stats.input_count += len(keys)
+        self.compaction_stats.output_count += int(numpy.count_nonzero(keep))
+        return [key for key, kept in zip(keys, keep) if kept]
+
+    def convert_location(self, vector):
+        return (vector.x * self.scale, vector.z * self.scale, vector.y * self.scale)
+
+    def convert_quaternion(self, quaternion):
+        return (-quaternion.x, -quaternion.z, -quaternion.y, quaternion.w)
 
-    def write_quaternion(self, file, quaternion):
-        # self.print_all(quaternion)
-        self.write_float(file, -quaternion.x)
-        self.write_float(file, -quaternion.z)
-        self.write_float(file, -quaternion.y)
-        self.write_float(file, quaternion.w)
+    def write_long(self, file, long):
+        # unsigned long(DWORD)
+        file.write(encoder.UINT32.pack(long))
 
-    def write_ipo(self, file):
-        for i in self.ipo_list:
-            file.write(struct.pack("b", i))
+    # 書き終えた位置の unsigned long を書き直す
+    def rewrite_long(self, file, position, long):
+        end = file.tell()
+        file.seek(position)
+        self.write_long(file, long)
+        file.seek(end)
 
-    def write_float(self, file, float):
-        file.write(struct.pack("f", float))
+    def encode_bone_name(self, bone):
+        return writer.encode_name(self.bone_name(bone), 15)
 
-    def write_long(self, file, long):
-        # unsigned long(DWORD)
-        file.write(struct.pack("L", long))
-
-    def write_int(self, file, int):
-        file.write(struct.pack("i", int))
-
-    def write_bone_name(self, file, bone):
-        bone_name = bone.name
-        if not bone.vmd_bone_properties.mmd_name:
-            bone_name = bone.vmd_bone_properties.mmd_name
-        barray = bytearray(bone_name.encode('shift_jis'))
-        self.write_bytearray(file, 15, barray)
-
-    def write_str(self, file, array_size, str):
-        barray = bytearray(str.encode('shift_jis'))
-        self.write_bytearray(file, array_size, barray)
-
-    def write_bytearray(self, file, array_size, barray):
-        ba_base = bytearray(array_size)
-        ba_base[:len(barray)] = barray
-        file.write(ba_base)
+    # MMD ボーン名が設定されていない場合はボーン名
+    def bone_name(self, bone):
+        return bone.vmd_bone_properties.mmd_name or bone.name
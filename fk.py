@@ -0,0 +1,419 @@
+import numpy
+from . sampler import matrix_to_array
+
+# frame_set を呼ばずに、アクションの F-Curve からポーズ行列 (アーマチュア空間) を計算する
+#
+# ポーズ行列 = 親のポーズ行列 * (親のレストの逆行列 * レスト) * (位置 * 回転 * スケール)
+# 親がない場合は レスト * (位置 * 回転 * スケール)
+# フレームはまとめて (FRAME_CHUNK フレームずつ) 配列で計算する
+#
+# 同じように計算できないボーン (IK などのコンストレイント、子孫の IK のチェーン、ドライバー、親の影響を受けない設定、NLA) が
+# 1 つでもある場合は unsupported に理由を入れ、呼び出し側は frame_set で評価する
+
+FRAME_CHUNK = 256
+
+# 対応するコンストレイント (ワールド空間どうし、影響 1.0)
+SUPPORTED_CONSTRAINTS = ('COPY_LOCATION', 'COPY_ROTATION', 'COPY_TRANSFORMS')
+
+class BoneChannels():
+    def __init__(self, pose_bone, index, parent_index, fcurve_map):
+        self.name = pose_bone.name
+        self.index = index
+        self.parent_index = parent_index
+        self.rotation_mode = pose_bone.rotation_mode
+
+        rest = matrix_to_array(pose_bone.bone.matrix_local)
+        if pose_bone.parent is None:
+            self.rest_relative = rest
+        else:
+            self.rest_relative = numpy.linalg.inv(matrix_to_array(pose_bone.parent.bone.matrix_local)).dot(rest)
+
+        if self.rotation_mode == 'QUATERNION':
+            rotation_name, rotation_value = "rotation_quaternion", pose_bone.rotation_quaternion
+        elif self.rotation_mode == 'AXIS_ANGLE':
+            rotation_name, rotation_value = "rotation_axis_angle", pose_bone.rotation_axis_angle
+        else:
+            rotation_name, rotation_value = "rotation_euler", pose_bone.rotation_euler
+
+        # (F-Curve または None, 動かない場合の値) のリスト
+        self.location = channel_sources(pose_bone, "location", pose_bone.location, fcurve_map)
+        self.rotation = channel_sources(pose_bone, rotation_name, rotation_value, fcurve_map)
+        self.scale = channel_sources(pose_bone, "scale", pose_bone.scale, fcurve_map)
+
+        # (種類, ターゲットのインデックス)
+        self.constraints = []
+
+    # (フレーム数, 4, 4) の 位置 * 回転 * スケール
+    def basis(self, frames):
+        location = evaluate_channels(self.location, frames)
+        rotation = evaluate_channels(self.rotation, frames)
+        scale = evaluate_channels(self.scale, frames)
+
+        if self.rotation_mode == 'QUATERNION':
+            rotation_matrix = quaternion_matrices(rotation)
+        elif self.rotation_mode == 'AXIS_ANGLE':
+            rotation_matrix = axis_angle_matrices(rotation)
+        else:
+            rotation_matrix = euler_matrices(rotation, self.rotation_mode)
+
+        matrices = numpy.zeros((len(frames), 4, 4))
+        matrices[:, :3, :3] = rotation_matrix * scale[:, numpy.newaxis, :]
+        matrices[:, :3, 3] = location
+        matrices[:, 3, 3] = 1.0
+        return matrices
+
+class ArmatureEvaluator():
+    # bones は計算するポーズボーン (親とコンストレイントのターゲットは自動で足す)
+    # frames は評価する順のフレーム (この順にまとめて計算する)
+    def __init__(self, obj, bones, frames):
+        self.obj = obj
+        self.pose = obj.pose
+        self.frames = list(frames)
+        self.frame_positions = {frame: i for i, frame in enumerate(self.frames)}
+        self.bone_size = len(self.pose.bones)
+        self.index_map = {bone.name: i for i, bone in enumerate(self.pose.bones)}
+
+        animation_data = obj.animation_data
+        self.action = animation_data.action if animation_data else None
+        self.driver_paths = [driver.data_path for driver in animation_data.drivers] if animation_data else []
+        fcurve_map = {}
+        if self.action is not None:
+            for fcurve in self.action.fcurves:
+                fcurve_map[(fcurve.data_path, fcurve.array_index)] = fcurve
+
+        # ボーン名 -> frame_set で評価する理由
+        self.unsupported = {}
+        self.order = []
+        self.rig_reason = rig_reason(animation_data)
+        # 訪れないボーン (子孫など) の IK もチェーンのボーンを動かすので、全てのボーンから集める
+        self.ik_bones = ik_chain_bones(self.pose)
+
+        visiting = set()
+        visited = {}
+        for pose_bone in bones:
+            self.visit(pose_bone, fcurve_map, visiting, visited)
+
+        self.chunk_frames = {}
+        self.chunk = None
+
+    # 親とコンストレイントのターゲットを先に並べる
+    def visit(self, pose_bone, fcurve_map, visiting, visited):
+        name = pose_bone.name
+        if name in visited:
+            return visited[name]
+        if name in visiting:
+            self.unsupported[name] = "dependency cycle"
+            return None
+        visiting.add(name)
+
+        reason = self.rig_reason or self.check_bone(pose_bone)
+
+        parent_index = None
+        if pose_bone.parent is not None:
+            parent = self.visit(pose_bone.parent, fcurve_map, visiting, visited)
+            if parent is None and reason is None:
+                reason = "parent " + pose_bone.parent.name
+            parent_index = self.index_map[pose_bone.parent.name]
+
+        constraints = []
+        for constraint in active_constraints(pose_bone):
+            target = self.pose.bones[constraint.subtarget] if reason is None else None
+            if target is not None and self.visit(target, fcurve_map, visiting, visited) is None:
+                reason = "target " + target.name
+            if target is not None:
+                constraints.append((constraint.type, self.index_map[target.name]))
+
+        visiting.discard(name)
+        if reason is not None:
+            self.unsupported.setdefault(name, reason)
+            visited[name] = None
+            return None
+
+        channels = BoneChannels(pose_bone, self.index_map[name], parent_index, fcurve_map)
+        channels.constraints = constraints
+        self.order.append(channels)
+        visited[name] = channels
+        return channels
+
+    def check_bone(self, pose_bone):
+        if pose_bone.name in self.ik_bones:
+            return "ik chain"
+        reason = bone_reason(pose_bone, self.driver_paths)
+        if reason is not None:
+            return reason
+
+        for constraint in active_constraints(pose_bone):
+            if not self.is_supported_constraint(constraint):
+                return "constraint " + constraint.type
+        return None
+
+    def is_supported_constraint(self, constraint):
+        if constraint.type not in SUPPORTED_CONSTRAINTS:
+            return False
+        if constraint.influence != 1.0 or constraint.owner_space != 'WORLD' or constraint.target_space != 'WORLD':
+            return False
+        if constraint.target != self.obj or constraint.subtarget not in self.pose.bones:
+            return False
+
+        if constraint.type == 'COPY_LOCATION':
+            return (constraint.use_x and constraint.use_y and constraint.use_z
+                and not (constraint.invert_x or constraint.invert_y or constraint.invert_z)
+                and not constraint.use_offset and constraint.head_tail == 0.0)
+        if constraint.type == 'COPY_ROTATION':
+            # ワールド空間の回転をアーマチュア空間に戻せるのは、オブジェクトが回転と一様なスケールだけの場合
+            return (constraint.use_x and constraint.use_y and constraint.use_z
+                and not (constraint.invert_x or constraint.invert_y or constraint.invert_z)
+                and not constraint.use_offset and self.is_similarity(self.obj.matrix_world))
+        return True
+
+    def is_similarity(self, matrix):
+        if self.obj.parent is not None or self.obj_transform_animated():
+            return False
+        rotation = matrix_to_array(matrix)[:3, :3]
+        product = rotation.T.dot(rotation)
+        return numpy.allclose(product, numpy.identity(3) * product[0, 0], atol=1e-6)
+
+    def obj_transform_animated(self):
+        if self.action is None:
+            return False
+        return any(not fcurve.data_path.startswith("pose.") for fcurve in self.action.fcurves)
+
+    # frame のポーズ行列 (ボーン数, 4, 4) を返す (計算しないボーンは単位行列)
+    def frame_matrices(self, frame):
+        if frame not in self.chunk_frames:
+            position = self.frame_positions.get(frame)
+            frames = [frame] if position is None else self.frames[position:position + FRAME_CHUNK]
+            self.chunk = self.evaluate(frames)
+            self.chunk_frames = {f: i for i, f in enumerate(frames)}
+        return self.chunk[self.chunk_frames[frame]]
+
+    # (フレーム数, ボーン数, 4, 4) を返す
+    def evaluate(self, frames):
+        frames = numpy.array(frames, dtype=numpy.float64)
+        matrices = numpy.zeros((len(frames), self.bone_size, 4, 4))
+        matrices[:] = numpy.identity(4)
+
+        for channels in self.order:
+            local = numpy.matmul(channels.rest_relative, channels.basis(frames))
+            if channels.parent_index is None:
+                matrix = local
+            else:
+                matrix = numpy.matmul(matrices[:, channels.parent_index], local)
+
+            for constraint_type, target_index in channels.constraints:
+                matrix = apply_constraint(constraint_type, matrix, matrices[:, target_index])
+            matrices[:, channels.index] = matrix
+
+        return matrices
+
+# 計算したポーズ行列と frame_set で評価したポーズ行列の差
+class Verification():
+    def __init__(self, bone_names, bone_indices, tolerance=1e-4):
+        self.bone_names = bone_names
+        self.bone_indices = numpy.array(bone_indices, dtype=numpy.intp)
+        self.tolerance = tolerance
+        self.frame_count = 0
+        self.max_error = 0.0
+        self.worst = None
+
+    def compare(self, frame, native, evaluated):
+        errors = numpy.abs(native[self.bone_indices] - evaluated[self.bone_indices]).max(axis=(1, 2))
+        self.frame_count += 1
+        if len(errors) > 0 and errors.max() > self.max_error:
+            worst = int(numpy.argmax(errors))
+            self.max_error = float(errors[worst])
+            self.worst = (self.bone_names[worst], frame)
+
+    @property
+    def passed(self):
+        return self.max_error <= self.tolerance
+
+    def __str__(self):
+        text = "native pose verification : {0} frames, max matrix error {1:.3g}".format(self.frame_count, self.max_error)
+        if self.worst is not None and self.max_error > 0.0:
+            text += " ({0} at frame {1})".format(*self.worst)
+        return text
+
+# アクションの F-Curve だけではポーズが決まらないリグの理由 (NLA、アクションのブレンド)
+# keyframes と共通
+def rig_reason(animation_data):
+    if animation_data is None:
+        return None
+    if any(not track.mute and len(track.strips) > 0 for track in animation_data.nla_tracks):
+        return "nla"
+    if getattr(animation_data, "action_blend_type", 'REPLACE') != 'REPLACE' or getattr(animation_data, "action_influence", 1.0) != 1.0:
+        return "action blending"
+    return None
+
+# F-Curve の値から親に対する変換を求められないボーンの理由 (親の影響を受けない設定、ドライバー)
+def bone_reason(pose_bone, driver_paths):
+    bone = pose_bone.bone
+    if not bone.use_inherit_rotation or not bone.use_inherit_scale or not bone.use_local_location:
+        return "inherit"
+
+    bone_path = pose_bone.path_from_id()
+    if any(data_path.startswith(bone_path) for data_path in driver_paths):
+        return "driver"
+    return None
+
+# 有効な IK, スプライン IK のチェーンに含まれるボーン名 (自分のコンストレイントがなくても子孫の IK で動く)
+# keyframes と共通
+def ik_chain_bones(pose):
+    names = set()
+    for pose_bone in pose.bones:
+        for constraint in active_constraints(pose_bone):
+            if constraint.type not in ('IK', 'SPLINE_IK'):
+                continue
+            # chain_count が 0 の IK はルートまで
+            chain_count = constraint.chain_count
+            bone = pose_bone
+            depth = 0
+            while bone is not None and (chain_count <= 0 or depth < chain_count):
+                names.add(bone.name)
+                bone = bone.parent
+                depth += 1
+    return names
+
+def active_constraints(pose_bone):
+    return [constraint for constraint in pose_bone.constraints if not constraint.mute and constraint.influence > 0.0]
+
+def channel_sources(pose_bone, name, values, fcurve_map):
+    data_path = pose_bone.path_from_id(name)
+    sources = []
+    for i, value in enumerate(values):
+        fcurve = fcurve_map.get((data_path, i))
+        if fcurve is not None and fcurve.mute:
+            fcurve = None
+        sources.append((fcurve, value))
+    return sources
+
+# (フレーム数, チャンネル数)
+def evaluate_channels(sources, frames):
+    values = numpy.empty((len(frames), len(sources)))
+    for i, (fcurve, value) in enumerate(sources):
+        values[:, i] = value if fcurve is None else evaluate_fcurve(fcurve, frames)
+    return values
+
+# F-Curve を全てのフレームでまとめて評価する
+# 一定、線形、ベジェの補間と一定の外挿だけを配列で計算し、それ以外 (モディファイアなど) は evaluate を呼ぶ
+def evaluate_fcurve(fcurve, frames):
+    points = fcurve.keyframe_points
+    count = len(points)
+    interpolations = [point.interpolation for point in points]
+    if (count <= 0 or fcurve.extrapolation != 'CONSTANT' or any(not modifier.mute for modifier in fcurve.modifiers)
+            or any(interpolation not in ('CONSTANT', 'LINEAR', 'BEZIER') for interpolation in interpolations)):
+        return numpy.array([fcurve.evaluate(frame) for frame in frames])
+
+    co = keyframe_array(points, "co", count)
+    left = keyframe_array(points, "handle_left", count)
+    right = keyframe_array(points, "handle_right", count)
+
+    values = numpy.empty(len(frames))
+    values[frames <= co[0, 0]] = co[0, 1]
+    values[frames >= co[-1, 0]] = co[-1, 1]
+    inside = (frames > co[0, 0]) & (frames < co[-1, 0])
+    if not inside.any():
+        return values
+
+    time = frames[inside]
+    index = numpy.clip(numpy.searchsorted(co[:, 0], time, side="right") - 1, 0, count - 2)
+    x0, y0 = co[index, 0], co[index, 1]
+    x1, y1 = co[index + 1, 0], co[index + 1, 1]
+    kind = numpy.array([{'CONSTANT': 0, 'LINEAR': 1, 'BEZIER': 2}[interpolation] for interpolation in interpolations])[index]
+
+    result = numpy.array(y0)
+    linear = kind == 1
+    result[linear] = y0[linear] + (y1[linear] - y0[linear]) * (time[linear] - x0[linear]) / (x1[linear] - x0[linear])
+
+    bezier = kind == 2
+    if bezier.any():
+        result[bezier] = bezier_values(co[index[bezier]], right[index[bezier]], left[index[bezier] + 1], co[index[bezier] + 1], time[bezier])
+
+    values[inside] = result
+    return values
+
+def keyframe_array(points, name, count):
+    values = numpy.empty(count * 2, dtype=numpy.float32)
+    points.foreach_get(name, values)
+    return values.reshape(count, 2).astype(numpy.float64)
+
+# Blender と同じく、ハンドルが区間をはみ出す場合は縮めてから x について解く
+def bezier_values(p0, p1, p2, p3, time):
+    length = p3[:, 0] - p0[:, 0]
+    h1 = p0 - p1
+    h2 = p3 - p2
+    handle_length = numpy.abs(h1[:, 0]) + numpy.abs(h2[:, 0])
+    factor = numpy.where(handle_length > length, length / numpy.maximum(handle_length, 1e-12), 1.0)[:, numpy.newaxis]
+    p1 = p0 - h1 * factor
+    p2 = p3 - h2 * factor
+
+    # x は単調なので二分法で解く
+    low = numpy.zeros(len(time))
+    high = numpy.ones(len(time))
+    for i in range(48):
+        s = (low + high) * 0.5
+        x = cubic(p0[:, 0], p1[:, 0], p2[:, 0], p3[:, 0], s)
+        below = x < time
+        low = numpy.where(below, s, low)
+        high = numpy.where(below, high, s)
+    s = (low + high) * 0.5
+    return cubic(p0[:, 1], p1[:, 1], p2[:, 1], p3[:, 1], s)
+
+def cubic(a, b, c, d, s):
+    u = 1.0 - s
+    return u * u * u * a + 3.0 * u * u * s * b + 3.0 * u * s * s * c + s * s * s * d
+
+def quaternion_matrices(quaternions):
+    length = numpy.linalg.norm(quaternions, axis=1)
+    quaternions = numpy.where(length[:, numpy.newaxis] > 0.0, quaternions / numpy.maximum(length, 1e-30)[:, numpy.newaxis], [1.0, 0.0, 0.0, 0.0])
+    w, x, y, z = quaternions.T
+    return numpy.stack([
+        numpy.stack([1.0 - 2.0 * (y * y + z * z), 2.0 * (x * y - w * z), 2.0 * (x * z + w * y)], axis=1),
+        numpy.stack([2.0 * (x * y + w * z), 1.0 - 2.0 * (x * x + z * z), 2.0 * (y * z - w * x)], axis=1),
+        numpy.stack([2.0 * (x * z - w * y), 2.0 * (y * z + w * x), 1.0 - 2.0 * (x * x + y * y)], axis=1)], axis=1)
+
+# (角度, x, y, z)
+def axis_angle_matrices(axis_angles):
+    angle = axis_angles[:, 0]
+    axis = axis_angles[:, 1:]
+    length = numpy.linalg.norm(axis, axis=1)
+    zero = length <= 0.0
+    axis = axis / numpy.where(zero, 1.0, length)[:, numpy.newaxis]
+    half = numpy.where(zero, 0.0, angle * 0.5)
+    quaternions = numpy.concatenate([numpy.cos(half)[:, numpy.newaxis], axis * numpy.sin(half)[:, numpy.newaxis]], axis=1)
+    return quaternion_matrices(quaternions)
+
+# order の順に回転する (XYZ の場合は Rz * Ry * Rx)
+def euler_matrices(eulers, order):
+    matrices = numpy.zeros((len(eulers), 3, 3))
+    matrices[:] = numpy.identity(3)
+    for axis_name in order:
+        axis = "XYZ".index(axis_name)
+        matrices = numpy.matmul(axis_matrices(axis, eulers[:, axis]), matrices)
+    return matrices
+
+def axis_matrices(axis, angles):
+    cos = numpy.cos(angles)
+    sin = numpy.sin(angles)
+    matrices = numpy.zeros((len(angles), 3, 3))
+    i, j = [(1, 2), (2, 0), (0, 1)][axis]
+    matrices[:, axis, axis] = 1.0
+    matrices[:, i, i] = cos
+    matrices[:, i, j] = -sin
+    matrices[:, j, i] = sin
+    matrices[:, j, j] = cos
+    return matrices
+
+def apply_constraint(constraint_type, matrix, target):
+    if constraint_type == 'COPY_TRANSFORMS':
+        return target.copy()
+
+    result = matrix.copy()
+    if constraint_type == 'COPY_LOCATION':
+        result[:, :3, 3] = target[:, :3, 3]
+    elif constraint_type == 'COPY_ROTATION':
+        # 位置とスケールはそのままで、回転をターゲットの回転にする
+        scale = numpy.linalg.norm(matrix[:, :3, :3], axis=1)
+        rotation = target[:, :3, :3] / numpy.linalg.norm(target[:, :3, :3], axis=1)[:, numpy.newaxis, :]
+        result[:, :3, :3] = rotation * scale[:, numpy.newaxis, :]
+    return result
@@ -0,0 +1,264 @@
+import math
+import mathutils
+import logging
+from . import const, fk
+from . core import encoder, reducer
+
+logger = logging.getLogger(const.ADDON_NAME)
+
+# アクションの F-Curve から直接キーフレームを作る
+# frame_set を呼ばずに、キーフレームの位置だけを評価して出力する
+# 区間の補間曲線はハンドルから作り、正確に変換できない区間だけ全てのフレームで誤差を確かめる
+# (時間はキー数と、正確に変換できない区間のフレーム数に比例する)
+class KeyframeSampler():
+    def __init__(self, obj, frame_start, frame_end, convert_location, convert_quaternion):
+        self.obj = obj
+        self.frame_start = frame_start
+        self.frame_end = frame_end
+        self.convert_location = convert_location
+        self.convert_quaternion = convert_quaternion
+
+        animation_data = obj.animation_data
+        self.action = animation_data.action if animation_data else None
+        self.driver_paths = [driver.data_path for driver in animation_data.drivers] if animation_data else []
+        self.rig_reason = fk.rig_reason(animation_data)
+        self.ik_bones = fk.ik_chain_bones(obj.pose)
+
+    # (キーフレームのフレームだけの Track, [(Track のインデックス, 補間データ)]) を返す
+    # 出力できない場合は None を返す
+    def export_bone(self, pose_bone, location_tolerance, angle_tolerance, stats=None):
+        if self.action is None:
+            logger.debug("no action : " + pose_bone.name)
+            return None
+        if self.rig_reason:
+            logger.debug("bake bone : " + pose_bone.name + " (" + self.rig_reason + ")")
+            return None
+
+        location_curves = self.find_curves(pose_bone, "location", 3)
+        if pose_bone.rotation_mode == 'QUATERNION':
+            rotation_curves = self.find_curves(pose_bone, "rotation_quaternion", 4)
+        else:
+            rotation_curves = self.find_curves(pose_bone, "rotation_euler", 3)
+
+        reason = self.check_bone(pose_bone, location_curves + rotation_curves)
+        if reason:
+            logger.debug("bake bone : " + pose_bone.name + " (" + reason + ")")
+            return None
+
+        key_frames = self.collect_key_frames(location_curves + rotation_curves)
+        if key_frames is None:
+            logger.debug("bake bone : " + pose_bone.name + " (subframe key)")
+            return None
+
+        location_keys = [keyframe_map(fcurve) for fcurve in location_curves]
+        rotation_keys = [keyframe_map(fcurve) for fcurve in rotation_curves]
+
+        track = reducer.Track()
+        for frame in key_frames:
+            location, quaternion = self.evaluate(pose_bone, location_curves, rotation_curves, frame)
+            track.append(frame, location, quaternion)
+
+        rest = pose_bone.bone.matrix_local.to_3x3()
+        # VMD の X, Y, Z は Blender の X, Z, Y
+        location_weights = [rest[0], rest[2], rest[1]]
+        rotation_weights = (1.0,) * len(rotation_curves)
+        # 回転は球面線形補間なので、正確なのは 1 つの軸だけが半周未満回るオイラー回転だけ
+        max_moving = 0 if pose_bone.rotation_mode == 'QUATERNION' else 1
+
+        errors = [0.0, 0.0]
+        keys = [(0, encoder.LINEAR_IPO)]
+        for index, (f0, f1) in enumerate(zip(key_frames, key_frames[1:])):
+            curves = [self.segment_curve(location_curves, location_keys, location_weights[axis], f0, f1) for axis in range(3)]
+            curves.append(self.segment_curve(rotation_curves, rotation_keys, rotation_weights, f0, f1, max_moving, math.pi))
+
+            if any(exact is not True for curve, exact in curves):
+                samples = self.sample_segment(pose_bone, location_curves, rotation_curves, track, index)
+                curves = [curve or encoder.LINEAR_CURVE for curve, exact in curves]
+                if not self.within_tolerance(samples, curves, location_tolerance, angle_tolerance, errors):
+                    # ハンドルから変換できない区間はフィットさせる
+                    curves = reducer.fit_curves(samples, 0, len(samples) - 1)
+                    if not self.within_tolerance(samples, curves, location_tolerance, angle_tolerance, errors):
+                        logger.debug("bake bone : " + pose_bone.name + " (frame " + str(f0) + " - " + str(f1) + ")")
+                        return None
+            else:
+                curves = [curve for curve, exact in curves]
+
+            keys.append((index + 1, encoder.build_ipo(*curves)))
+
+        if stats is not None:
+            stats.input_count += self.frame_end - self.frame_start + 1
+            stats.output_count += len(keys)
+            stats.max_location_error = max(stats.max_location_error, errors[0])
+            stats.max_angle_error = max(stats.max_angle_error, errors[1])
+
+        return track, keys
+
+    # 区間の全てのフレームの Track
+    def sample_segment(self, pose_bone, location_curves, rotation_curves, track, index):
+        f0 = track.frames[index]
+        f1 = track.frames[index + 1]
+        samples = reducer.Track()
+        samples.append(f0, track.locations[index], track.quaternions[index])
+        for frame in range(f0 + 1, f1):
+            samples.append(frame, *self.evaluate(pose_bone, location_curves, rotation_curves, frame))
+        samples.append(f1, track.locations[index + 1], track.quaternions[index + 1])
+        return samples
+
+    # errors には採用した区間の (位置の最大誤差, 角度の最大誤差) を入れる
+    def within_tolerance(self, samples, curves, location_tolerance, angle_tolerance, errors):
+        location_error, angle_error = reducer.segment_error(samples, 0, len(samples) - 1, curves)
+        if location_error > location_tolerance or angle_error > angle_tolerance:
+            return False
+        errors[0] = max(errors[0], location_error)
+        errors[1] = max(errors[1], angle_error)
+        return True
+
+    def find_curves(self, pose_bone, name, size):
+        data_path = pose_bone.path_from_id(name)
+        return [self.action.fcurves.find(data_path, i) for i in range(size)]
+
+    def check_bone(self, pose_bone, curves):
+        bone = pose_bone.bone
+
+        if pose_bone.rotation_mode == 'AXIS_ANGLE':
+            return "axis angle"
+        if pose_bone.name in self.ik_bones:
+            return "ik chain"
+        reason = fk.bone_reason(pose_bone, self.driver_paths)
+        if reason is not None:
+            return reason
+        if any(not constraint.mute for constraint in pose_bone.constraints):
+            return "constraint"
+
+        mmd_parent = bone.vmd_bone_properties.mmd_parent
+        if mmd_parent and (pose_bone.parent is None or pose_bone.parent.name != mmd_parent):
+            return "mmd parent"
+
+        for fcurve in curves:
+            if fcurve is None:
+                continue
+            if fcurve.extrapolation != 'CONSTANT':
+                return "extrapolation"
+            if any(not modifier.mute for modifier in fcurve.modifiers):
+                return "modifier"
+
+        # 親のスケールは回転に影響するので、スケールしない親のみ対象にする
+        parent = pose_bone.parent
+        while parent is not None:
+            if tuple(parent.scale) != (1.0, 1.0, 1.0) or any(self.find_curves(parent, "scale", 3)):
+                return "parent scale"
+            parent = parent.parent
+
+        return None
+
+    # 範囲内のキーフレーム位置を返す (整数でないフレームがある場合は None)
+    def collect_key_frames(self, curves):
+        key_frames = {self.frame_start}
+        for fcurve in curves:
+            if fcurve is None:
+                continue
+            for keyframe in fcurve.keyframe_points:
+                frame = keyframe.co[0]
+                if frame != round(frame):
+                    return None
+                frame = int(round(frame))
+                if frame > self.frame_end:
+                    key_frames.add(self.frame_end)
+                elif frame >= self.frame_start:
+                    key_frames.add(frame)
+        return sorted(key_frames)
+
+    def evaluate(self, pose_bone, location_curves, rotation_curves, frame):
+        location = mathutils.Vector([fcurve.evaluate(frame) if fcurve else value for fcurve, value in zip(location_curves, pose_bone.location)])
+
+        if pose_bone.rotation_mode == 'QUATERNION':
+            rotation = mathutils.Quaternion([fcurve.evaluate(frame) if fcurve else value for fcurve, value in zip(rotation_curves, pose_bone.rotation_quaternion)])
+            rotation.normalize()
+        else:
+            euler = [fcurve.evaluate(frame) if fcurve else value for fcurve, value in zip(rotation_curves, pose_bone.rotation_euler)]
+            rotation = mathutils.Euler(euler, pose_bone.rotation_mode).to_quaternion()
+
+        # 親に対する位置と回転をレストの向きに変換する
+        rest = pose_bone.bone.matrix_local.to_quaternion()
+        location_mmd = rest * location
+        quaternion_mmd = rest * rotation * rest.inverted()
+
+        return self.convert_location(location_mmd), self.convert_quaternion(quaternion_mmd)
+
+    # (補間曲線, 正確か) を返す
+    # 区間で変化するチャンネルのハンドルが全て同じ補間曲線になる場合は正確
+    # そうでない場合は一番大きく変化するチャンネルの補間曲線 (変換できない場合は None) を返し、呼び出し側で誤差を確かめる
+    # max_moving, max_delta がある場合は、変化するチャンネルの数と変化量がそれ以下の場合だけ正確とする
+    def segment_curve(self, curves, keys, weights, f0, f1, max_moving=None, max_delta=None):
+        candidate = None
+        candidate_delta = 1e-9
+        exact = True
+        moving = []
+        for fcurve, keyframes, weight in zip(curves, keys, weights):
+            if fcurve is None or abs(weight) <= 1e-6:
+                continue
+            keyframe_start = keyframes.get(f0)
+            keyframe_end = keyframes.get(f1)
+            if keyframe_start is None or keyframe_end is None:
+                # 区間の両端にキーがない (他のチャンネルとキーの位置が違う)
+                exact = False
+                delta = abs(weight * (fcurve.evaluate(f1) - fcurve.evaluate(f0)))
+                curve = None
+            else:
+                if is_constant_segment(keyframe_start, keyframe_end):
+                    continue
+                delta = abs(weight * (keyframe_end.co[1] - keyframe_start.co[1]))
+                curve = keyframe_segment_curve(keyframe_start, keyframe_end)
+                if curve is None or (max_delta is not None and delta >= max_delta):
+                    exact = False
+            moving.append(curve)
+            if delta > candidate_delta:
+                candidate = curve
+                candidate_delta = delta
+
+        if not moving:
+            return encoder.LINEAR_CURVE, True
+        if len(set(moving)) > 1 or (max_moving is not None and len(moving) > max_moving):
+            exact = False
+        if candidate is None:
+            return None, False
+        return candidate, exact
+
+# キーフレームのフレーム -> キーフレーム (F-Curve がない場合は空)
+def keyframe_map(fcurve):
+    if fcurve is None:
+        return {}
+    return {int(round(keyframe.co[0])): keyframe for keyframe in fcurve.keyframe_points}
+
+# 両端が同じ値で、ハンドルも区間内で値を変えない
+def is_constant_segment(keyframe_start, keyframe_end):
+    value = keyframe_start.co[1]
+    if keyframe_end.co[1] != value:
+        return False
+    if keyframe_start.interpolation in ('CONSTANT', 'LINEAR'):
+        return True
+    return keyframe_start.handle_right[1] == value and keyframe_end.handle_left[1] == value
+
+# キーフレームの区間を VMD の補間曲線に変換する (変換できない場合は None)
+def keyframe_segment_curve(keyframe_start, keyframe_end):
+    if keyframe_start.interpolation == 'LINEAR':
+        return encoder.LINEAR_CURVE
+    if keyframe_start.interpolation != 'BEZIER':
+        return None
+
+    f0 = keyframe_start.co[0]
+    duration = keyframe_end.co[0] - f0
+    delta = keyframe_end.co[1] - keyframe_start.co[1]
+    if abs(delta) <= 1e-9:
+        return None
+
+    x1 = (keyframe_start.handle_right[0] - f0) / duration
+    y1 = (keyframe_start.handle_right[1] - keyframe_start.co[1]) / delta
+    x2 = (keyframe_end.handle_left[0] - f0) / duration
+    y2 = (keyframe_end.handle_left[1] - keyframe_start.co[1]) / delta
+
+    # VMD は制御点が 0-1 の範囲に収まる曲線しか表せない
+    if not all(0.0 <= value <= 1.0 for value in (x1, y1, x2, y2)):
+        return None
+
+    return tuple(reducer.quantize(value) for value in (x1, y1, x2, y2))
@@ -0,0 +1,50 @@
+import numpy
+from . import sampler
+from . core import encoder, reducer
+
+# ボーンと同じフレームのループでシェイプキーの値をまとめて読み、表情キーフレームにする
+class MorphSampler(sampler.FrameSampler):
+    def __init__(self, obj):
+        super().__init__()
+        key = obj.data.shape_keys
+        self.key_blocks = key.key_blocks
+        self.indices = [i for i, key_block in enumerate(self.key_blocks) if key_block != key.reference_key]
+        self.names = [encode_morph_name(obj.data, self.key_blocks[i]) for i in self.indices]
+
+        self.buffer = numpy.empty(len(self.key_blocks), dtype=numpy.float32)
+
+    # frame_set の直後に呼ぶ
+    def sample(self, frame):
+        self.key_blocks.foreach_get("value", self.buffer)
+        self.frames.append(frame)
+        self.values.append(self.buffer[self.indices])
+
+    # 値が変わらない区間は最初と最後のキーフレームだけを残す
+    def records(self, frame_offset):
+        if not self.frames or not self.indices:
+            return numpy.zeros(0, dtype=encoder.MORPH_RECORD_DTYPE)
+
+        frames = numpy.array(self.frames, dtype=numpy.int64)
+        order = numpy.argsort(frames, kind="mergesort")
+        frames = frames[order]
+        values = numpy.array(self.values)[order]
+
+        keep = reducer.keep_changes(values)
+
+        # 表情ごとにフレーム順で並べる
+        morph_indices, frame_indices = numpy.nonzero(keep.T)
+        records = numpy.zeros(len(frame_indices), dtype=encoder.MORPH_RECORD_DTYPE)
+        records["name"] = numpy.array(self.names, dtype="S15")[morph_indices]
+        records["frame"] = frames[frame_indices] + frame_offset
+        records["weight"] = values[frame_indices, morph_indices]
+        return records
+
+# メッシュに MMD表情名 の設定がなければシェイプキー名を使う
+def morph_name(mesh, key_block):
+    vmd_morph_properties = mesh.vmd_morph_names.get(key_block.name)
+    if vmd_morph_properties is None or not vmd_morph_properties.mmd_name:
+        return key_block.name
+    return vmd_morph_properties.mmd_name
+
+def encode_morph_name(mesh, key_block):
+    return morph_name(mesh, key_block).encode('shift_jis')
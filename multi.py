@@ -0,0 +1,79 @@
+import logging
+from . import const, timing
+from . exporter import Exporter
+
+logger = logging.getLogger(const.ADDON_NAME)
+
+# シーンのアーマチュアをまとめて 1 回のタイムラインの走査で出力する
+# 各 Exporter は評価するフレームを yield してから評価するので、
+# 一番小さいフレームで frame_set を 1 回だけ呼び、そのフレームを待っている Exporter を全て進める
+
+# 出力先が設定されているアーマチュア
+def configured_armatures(scene):
+    armatures = []
+    for obj in scene.objects:
+        if obj.type != 'ARMATURE':
+            continue
+        vmd_armature_properties = obj.data.vmd_armature_properties
+        if vmd_armature_properties.export_folder and vmd_armature_properties.file_name:
+            armatures.append(obj)
+    return armatures
+
+# 1 つの Exporter の次に評価するフレーム
+class FrameRequest():
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.steps = exporter.export_steps()
+        self.frame = None
+
+    # 次に評価するフレームまで進める (終わった場合は False)
+    def advance(self):
+        while True:
+            try:
+                self.frame = next(self.steps)
+            except StopIteration:
+                return False
+            if self.frame is not None:
+                return True
+
+# 出力した Exporter のリストを返す
+def export_all(scene, objs=None):
+    if objs is None:
+        objs = configured_armatures(scene)
+    exporters = [Exporter(scene, obj) for obj in objs]
+
+    for step in export_steps(scene, exporters):
+        pass
+
+    exported = [exporter for exporter in exporters if exporter.exported]
+    logger.info("exported armatures : " + str(len(exported)) + " / " + str(len(exporters)))
+    return exported
+
+# frame_set を呼ぶたびに yield する
+def export_steps(scene, exporters):
+    stage_timer = timing.StageTimer()
+    requests = []
+    try:
+        for exporter in exporters:
+            exporter.shared_frames = True
+            request = FrameRequest(exporter)
+            requests.append(request)
+        requests = [request for request in requests if request.advance()]
+
+        while requests:
+            frame = min(request.frame for request in requests)
+            with stage_timer.stage("frame_set"):
+                scene.frame_set(frame)
+
+            for request in [request for request in requests if request.frame == frame]:
+                if not request.advance():
+                    requests.remove(request)
+            yield frame
+    finally:
+        for request in requests:
+            request.steps.close()
+        for exporter in exporters:
+            exporter.shared_frames = False
+
+    logger.info("shared frame_set : {0} frames ({1:.3f} sec), {2} armatures".format(
+        stage_timer.calls.get("frame_set", 0), stage_timer.seconds.get("frame_set", 0.0), len(exporters)))
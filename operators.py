@@ -0,0 +1,197 @@
+import bpy
+import logging
+import os
+import time
+from . import const, logutils
+from bpy.props import CollectionProperty, StringProperty
+
+logger = logging.getLogger(const.ADDON_NAME)
+
+# UI から呼ぶオペレーター
+# アドオンの登録を軽くするため、エクスポート処理のモジュールは実行するときに読み込む
+
+class VmdExporter(bpy.types.Operator):
+    bl_idname = "vmd.exporter"
+    bl_label = "Export VMD"
+
+    def __init__(self):
+        vmd_armature_properties = bpy.context.armature.vmd_armature_properties
+        self.use_modal = vmd_armature_properties.use_modal
+        self.chunk_size = vmd_armature_properties.chunk_size
+        self.workers = vmd_armature_properties.workers
+
+    def invoke(self, context, event):
+        # エクスポート処理 (NumPy を含む) は最初のエクスポートで読み込む
+        from . exporter import Exporter
+        self.exporter = Exporter(context.scene, context.object)
+
+        if self.use_modal and self.workers <= 1:
+            return self.start_modal(context)
+
+        # ログ (段階ごとの時間を含む) をテキスト vmd_exporter.log に残す
+        with logutils.LoggingToTextContext(logger):
+            if self.workers > 1:
+                from . import shard
+                shard_reason = self.exporter.shard_reason()
+                if shard_reason is not None:
+                    self.report({'WARNING'}, "Exported in one process (" + shard_reason + " needs a single process)")
+                shard.export_sharded(self.exporter, self.workers)
+            else:
+                self.exporter.export_vmd()
+        self.report_stats()
+
+        return {"FINISHED"}
+
+    def report_stats(self):
+        for error in self.exporter.errors:
+            self.report({'ERROR'}, error)
+        if self.exporter.reduction_stats is not None:
+            self.report({'INFO'}, str(self.exporter.reduction_stats))
+        if self.exporter.compaction_stats is not None:
+            self.report({'INFO'}, str(self.exporter.compaction_stats))
+        if self.exporter.pose_verification is not None:
+            self.report({'INFO'} if self.exporter.pose_verification.passed else {'WARNING'}, str(self.exporter.pose_verification))
+        if self.exporter.exported:
+            self.report({'INFO'}, str(self.exporter.stage_timer))
+
+    # タイマーごとに chunk_size フレームずつ進める (Esc で中断)
+    def start_modal(self, context):
+        self.log_context = logutils.LoggingToTextContext(logger)
+        self.log_context.__enter__()
+        self.steps = self.exporter.export_steps()
+        self.frame_count = 0
+        self.time_start = time.perf_counter()
+
+        wm = context.window_manager
+        wm.progress_begin(0, max(self.exporter.frame_size, 1))
+        self.timer = wm.event_timer_add(0.001, context.window)
+        wm.modal_handler_add(self)
+
+        return {"RUNNING_MODAL"}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.steps.close()
+            logger.info("cancelled : " + str(self.frame_count) + " frames")
+            self.end_modal(context)
+            self.report({'WARNING'}, "Export cancelled")
+            return {"CANCELLED"}
+
+        if event.type != 'TIMER':
+            return {"PASS_THROUGH"}
+
+        try:
+            for i in range(self.chunk_size):
+                next(self.steps)
+                self.frame_count += 1
+        except StopIteration:
+            self.end_modal(context)
+            self.report_stats()
+            return {"FINISHED"}
+        except Exception:
+            self.end_modal(context)
+            raise
+
+        self.update_progress(context)
+        return {"RUNNING_MODAL"}
+
+    def update_progress(self, context):
+        elapsed = time.perf_counter() - self.time_start
+        fps = self.frame_count / elapsed if elapsed > 0.0 else 0.0
+        eta = max(self.exporter.frame_size - self.frame_count, 0) / fps if fps > 0.0 else 0.0
+
+        context.window_manager.progress_update(min(self.frame_count, self.exporter.frame_size))
+        if context.area:
+            context.area.header_text_set("VMD Export : {0} / {1} frames, {2:.1f} fps, ETA {3:.0f} sec (Esc to cancel)".format(
+                self.frame_count, self.exporter.frame_size, fps, eta))
+
+    def end_modal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        if context.area:
+            context.area.header_text_set()
+        self.log_context.__exit__(None, None, None)
+
+# 出力先が設定されているシーンの全アーマチュアを、フレームを 1 回ずつ評価して出力する
+class VmdExportAll(bpy.types.Operator):
+    bl_idname = "vmd.export_all"
+    bl_label = "Export all armatures"
+    bl_description = "Export every armature with an export folder and file name, evaluating each frame once"
+
+    def invoke(self, context, event):
+        from . import multi
+
+        with logutils.LoggingToTextContext(logger):
+            exported = multi.export_all(context.scene)
+        self.report({'INFO'}, "Exported " + str(len(exported)) + " VMD files")
+
+        return {"FINISHED"}
+
+# 差分エクスポートのキャッシュを消し、次のエクスポートで全てのフレームを評価させる
+class VmdClearCache(bpy.types.Operator):
+    bl_idname = "vmd.clear_cache"
+    bl_label = "Clear cache"
+    bl_description = "Delete the incremental export cache so the next export evaluates every frame"
+
+    def invoke(self, context, event):
+        from . exporter import Exporter
+
+        exporter = Exporter(context.scene, context.object)
+        if not exporter.export_folder or not exporter.file_name:
+            self.report({'ERROR'}, "Set the export folder and file name first")
+            return {"CANCELLED"}
+        exporter.init_path()
+
+        path = exporter.cache_path()
+        if not os.path.exists(path):
+            self.report({'INFO'}, "No cache : " + path)
+            return {"FINISHED"}
+        os.remove(path)
+        self.report({'INFO'}, "Removed " + path)
+        return {"FINISHED"}
+
+# 出力済みの VMD ファイルを 1 つにまとめる (フレームが重なる場合は後のファイルを使う)
+class VmdSplice(bpy.types.Operator):
+    bl_idname = "vmd.splice"
+    bl_label = "Combine VMD files"
+    bl_description = "Combine exported VMD files into one without re-exporting (later files win where frames overlap)"
+
+    filter_glob = StringProperty(default="*.vmd", options={'HIDDEN'})
+    directory = StringProperty(subtype='DIR_PATH')
+    files = CollectionProperty(type=bpy.types.OperatorFileListElement)
+    output_name = StringProperty(name="Output file name", description="File name of the combined VMD in the same folder", default="combined.vmd")
+    offsets = StringProperty(name="Frame offsets", description="Comma separated frame offsets of the files in name order (missing offsets are 0)")
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {"RUNNING_MODAL"}
+
+    def execute(self, context):
+        from . core import splice
+
+        names = sorted(file.name for file in self.files if file.name)
+        if not names:
+            self.report({'ERROR'}, "No VMD files selected")
+            return {"CANCELLED"}
+        try:
+            offsets = [int(offset) for offset in self.offsets.replace(" ", "").split(",") if offset]
+        except ValueError:
+            self.report({'ERROR'}, "Invalid frame offsets : " + self.offsets)
+            return {"CANCELLED"}
+        offsets += [0] * (len(names) - len(offsets))
+
+        output_name = self.output_name if self.output_name.lower().endswith(".vmd") else self.output_name + ".vmd"
+        output_path = os.path.join(self.directory, output_name)
+        inputs = [(os.path.join(self.directory, name), offset) for name, offset in zip(names, offsets)]
+
+        try:
+            stats = splice.splice(inputs, output_path)
+        except (OSError, ValueError) as e:
+            logger.exception("splice")
+            self.report({'ERROR'}, str(e))
+            return {"CANCELLED"}
+
+        logger.info(output_path + " : " + str(stats))
+        self.report({'INFO'}, str(stats))
+        return {"FINISHED"}
@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+
+# 書き込みを別スレッドで行うファイル
+# write はデータをキューに入れるだけで、キューがいっぱいの場合だけ待つ (メモリは max_blocks 個分まで)
+# 書き込みで起きた例外は次の write, seek か close で呼び出し側に送出する
+class BackgroundWriter():
+    def __init__(self, file, max_blocks=64):
+        self.file = file
+        self.queue = queue.Queue(max(max_blocks, 1))
+        self.position = file.tell()
+        self.error = None
+        self.aborted = False
+        # キューが空くのを待った時間
+        self.wait_seconds = 0.0
+        self.wait_count = 0
+
+        self.thread = threading.Thread(target=self.run, name="vmd writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        # 呼び出し側がバッファを使い回しても書く内容が変わらないようにコピーする
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.put(("write", data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    # ヘッダーの書き直しに使う (先頭からの位置だけ)
+    def seek(self, offset, whence=0):
+        if whence != 0:
+            raise ValueError("only absolute seek is supported")
+        self.put(("seek", offset))
+        self.position = offset
+        return offset
+
+    def put(self, item):
+        self.raise_error()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            time_start = time.perf_counter()
+            self.queue.put(item)
+            self.wait_seconds += time.perf_counter() - time_start
+            self.wait_count += 1
+
+    # エラーの後や中断の後も、put が止まらないようにキューを空にし続ける
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None or self.aborted:
+                continue
+            try:
+                operation, value = item
+                if operation == "write":
+                    self.file.write(value)
+                else:
+                    self.file.seek(value)
+            except BaseException as e:
+                self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    # 残りを書き終えるまで待つ
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.raise_error()
+
+    # 残りを捨ててスレッドを止める (close した後は何もしない)
+    def abort(self):
+        if self.thread is None:
+            return
+        self.aborted = True
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
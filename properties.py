@@ -1,10 +1,11 @@
 import bpy
+import fnmatch
 import logging
 import math
 import mathutils
 import os
 import bpy.utils.previews
-from . exporter import VmdExporter
+from . operators import VmdClearCache, VmdExporter, VmdExportAll, VmdSplice
 from bpy.types import Panel, PropertyGroup
 from . import const
 from bpy.props import PointerProperty, StringProperty, CollectionProperty, IntProperty, BoolProperty, IntVectorProperty, FloatVectorProperty, FloatProperty, EnumProperty, BoolVectorProperty
@@ -16,11 +17,28 @@ logger = logging.getLogger(const.ADDON_NAME)
 class VMDSceneProperties(PropertyGroup):
     scale = FloatProperty(name="Scale", min=0.00001, max=100000.0, step=1, default=100.0, precision=3)
 
+# ボーンの設定が変わったら一覧の絞り込みを作り直す
+def bone_slots_update(self, context):
+    OBJECT_UL_bone_slots.revision += 1
+
 class VMDBoneProperties(bpy.types.PropertyGroup):
-    export = BoolProperty(name="Export", description="Export bone data", default=False)
-    mmd_name = StringProperty(name="MMD bone name", description="MMD bone name")
+    export = BoolProperty(name="Export", description="Export bone data", default=False, update=bone_slots_update)
+    mmd_name = StringProperty(name="MMD bone name", description="MMD bone name", update=bone_slots_update)
     mmd_parent = StringProperty(name="MMD parent bone", description="MMD parent bone")
 
+# シェイプキーにはプロパティを追加できないので、メッシュにシェイプキー名 (name) -> MMD表情名 の対応を持つ
+class VMDMorphProperties(bpy.types.PropertyGroup):
+    mmd_name = StringProperty(name="MMD morph name", description="MMD morph name")
+
+def morph_object_poll(self, obj):
+    return obj.type == 'MESH'
+
+def camera_object_poll(self, obj):
+    return obj.type == 'CAMERA'
+
+def light_object_poll(self, obj):
+    return obj.type == 'LAMP'
+
 class VMDArmatureProperties(bpy.types.PropertyGroup):
     def frame_start_update_event(self, context):
         if self.frame_start > self.frame_end:
@@ -40,8 +58,27 @@ class VMDArmatureProperties(bpy.types.PropertyGroup):
     frame_start = IntProperty(name="Start", default=1, update=frame_start_update_event)
     frame_end = IntProperty(name="End", default=60, update=frame_end_update_event)
     use_marker_mode = BoolProperty(name="Use merker mode", description="Use merker mode", default=False)
+    use_fcurve_frames = BoolProperty(name="Use keyframe frames", description="Export only frames where exported bones or their parents have keyframes (combined with markers)", default=False)
     scale = FloatProperty(name="Location scale", default=1.0/0.2)
     frame_offset = IntProperty(name="Frame offset", default=0)
+    use_keyframes = BoolProperty(name="Keyframes only", description="Export only keyframes of the active action and bake bones that can not be converted", default=False)
+    use_reduction = BoolProperty(name="Reduce keyframes", description="Reduce keyframes with interpolation curves", default=False)
+    reduction_location_tolerance = FloatProperty(name="Location tolerance", description="Max location error of reduced keyframes", min=0.0, default=0.01, precision=4)
+    reduction_angle_tolerance = FloatProperty(name="Angle tolerance", description="Max angle error of reduced keyframes", subtype='ANGLE', min=0.0, default=math.radians(0.5))
+    use_compaction = BoolProperty(name="Remove duplicate keys", description="Remove keys between identical keys and repeated keys at the end (the pose does not change)", default=False)
+    use_modal = BoolProperty(name="Run in background", description="Export in steps with progress, press Esc to cancel", default=False)
+    chunk_size = IntProperty(name="Frames per step", description="Number of frames exported per step", min=1, default=10)
+    workers = IntProperty(name="Worker processes", description="Split frames across background Blender processes (plain bake only; incremental, background write and profile export run in one process)", min=1, default=1)
+    use_native_pose = BoolProperty(name="Native pose evaluation", description="Compute bone poses from the action without frame_set (falls back to frame_set for constraints, drivers and NLA)", default=False)
+    verify_native_pose = BoolProperty(name="Verify native pose", description="Also evaluate every frame with frame_set and log the largest difference", default=False)
+    use_background_writer = BoolProperty(name="Write in background", description="Write the file on a separate thread so slow disks do not stall the export", default=False)
+    write_queue_size = IntProperty(name="Write queue size", description="Max number of blocks waiting to be written (limits memory)", min=1, default=64)
+    morph_object = PointerProperty(name="Morph mesh", description="Export shape key values of this mesh as morphs", type=bpy.types.Object, poll=morph_object_poll)
+    camera_object = PointerProperty(name="Camera", description="Export motion of this camera (target distance is the distance to the focus object, or the focus distance)", type=bpy.types.Object, poll=camera_object_poll)
+    light_object = PointerProperty(name="Light", description="Export color and direction of this lamp", type=bpy.types.Object, poll=light_object_poll)
+    use_cache = BoolProperty(name="Incremental export", description="Reuse keyframes of unchanged frames from a cache next to the VMD file (plain bake only)", default=False)
+    cache_size = IntProperty(name="Cache size (MB)", description="Max size of the cache file", min=1, default=256)
+    use_profile = BoolProperty(name="Profile export", description="Write cProfile stats of the export next to the VMD file (.prof)", default=False)
     use_version = BoolProperty(name="Use version", description="Use version", default=False)
     auto_increment = BoolProperty(name="Auto increment version number", description="Auto increment version number", default=False)
     version_format = StringProperty(name="Version format", description="Version format", default="-${major}.${minor}.${build}")
@@ -67,6 +104,57 @@ class VMDBoneSlotsActions(bpy.types.Operator):
 
         return {"FINISHED"}
 
+# 選択したボーンの設定をまとめて変える
+class VMDBoneSlotsEditSelected(bpy.types.Operator):
+    bl_idname = "vmd.bone_slots_edit_selected"
+    bl_label = "Edit selected bones"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    export = EnumProperty(name="Export", items=(('KEEP', "Keep", ""), ('ON', "Export", ""), ('OFF', "Don't export", "")))
+    use_mmd_parent = BoolProperty(name="Set MMD parent bone", default=False)
+    mmd_parent = StringProperty(name="MMD parent bone", description="MMD parent bone")
+    clear_mmd_name = BoolProperty(name="Clear MMD bone name", default=False)
+
+    @classmethod
+    def poll(cls, context):
+        return context.armature
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "export", expand=True)
+        row = layout.row()
+        row.prop(self, "use_mmd_parent", text="")
+        row.prop_search(self, "mmd_parent", context.armature, "bones", icon='CONSTRAINT_BONE')
+        layout.prop(self, "clear_mmd_name")
+
+    def execute(self, context):
+        arm = context.armature
+        bones = selected_bones(context, arm)
+        if not bones:
+            self.report({'WARNING'}, "No bones selected")
+            return {"CANCELLED"}
+
+        for bone in bones:
+            vmd_bone_properties = bone.vmd_bone_properties
+            if self.export != 'KEEP':
+                vmd_bone_properties.export = self.export == 'ON'
+            if self.use_mmd_parent:
+                vmd_bone_properties.mmd_parent = self.mmd_parent
+            if self.clear_mmd_name:
+                vmd_bone_properties.mmd_name = ""
+
+        self.report({'INFO'}, "{0} bones edited".format(len(bones)))
+        return {"FINISHED"}
+
+# 編集モードでは Bone の選択が更新されないので EditBone の選択を使う
+def selected_bones(context, arm):
+    if context.mode == 'EDIT_ARMATURE':
+        return [arm.bones[edit_bone.name] for edit_bone in arm.edit_bones if edit_bone.select and edit_bone.name in arm.bones]
+    return [bone for bone in arm.bones if bone.select]
+
 class SetMMDBoneNameAction(bpy.types.Operator):
     bl_idname = "vmd.set_mmd_bone_name"
     bl_label = "Convert L/R to Japanese"
@@ -153,7 +241,9 @@ class PMXArmaturePanel(ArmatureButtonsPanel, Panel):
         row.prop(vmd_armature_properties, "file_name")
 
         if vmd_armature_properties.property_type == "1":
-            layout.prop(vmd_armature_properties, "use_marker_mode")
+            row = layout.row()
+            row.prop(vmd_armature_properties, "use_marker_mode")
+            row.prop(vmd_armature_properties, "use_fcurve_frames")
 
         row = layout.row(align=True)
         row.prop(vmd_armature_properties, "frame_start")
@@ -162,6 +252,15 @@ class PMXArmaturePanel(ArmatureButtonsPanel, Panel):
         if vmd_armature_properties.property_type == "1":
             layout.prop(vmd_armature_properties, "frame_offset")
             layout.prop(vmd_armature_properties, "scale")
+            layout.prop(vmd_armature_properties, "morph_object")
+            layout.prop(vmd_armature_properties, "camera_object")
+            camera_object = vmd_armature_properties.camera_object
+            if camera_object and camera_object.type == 'CAMERA' and camera_object.data.dof_object is None and camera_object.data.dof_distance <= 0.0:
+                layout.label("Set the focus distance or focus object of the camera", icon='ERROR')
+            layout.prop(vmd_armature_properties, "light_object")
+            self.draw_reduction(layout, vmd_armature_properties)
+            self.draw_modal(layout, vmd_armature_properties)
+            self.draw_cache(layout, vmd_armature_properties)
             self.draw_version(layout, vmd_armature_properties)
 
         row = layout.row(align=True)
@@ -171,9 +270,52 @@ class PMXArmaturePanel(ArmatureButtonsPanel, Panel):
         if not vmd_armature_properties.export_folder or not vmd_armature_properties.file_name:
             row.enabled = False
 
+        layout.operator(VmdExportAll.bl_idname, text=pgettext(VmdExportAll.bl_label), icon='ARMATURE_DATA')
+        layout.operator(VmdSplice.bl_idname, text=pgettext(VmdSplice.bl_label), icon='FILE_MOVIE')
+
         if len(arm.bones) <= 0:
             layout.enabled = False
 
+    def draw_reduction(self, layout, properties):
+            box = layout.box()
+            box.prop(properties, "use_keyframes")
+            box.prop(properties, "use_reduction")
+            box.prop(properties, "use_compaction")
+
+            column = box.column(align=True)
+            column.prop(properties, "reduction_location_tolerance")
+            column.prop(properties, "reduction_angle_tolerance")
+            column.enabled = properties.use_reduction or properties.use_keyframes
+
+    def draw_modal(self, layout, properties):
+            box = layout.box()
+            row = box.row()
+            row.prop(properties, "use_modal")
+            column = row.column()
+            column.prop(properties, "chunk_size")
+            column.enabled = properties.use_modal
+            box.prop(properties, "workers")
+            row = box.row()
+            row.prop(properties, "use_native_pose")
+            column = row.column()
+            column.prop(properties, "verify_native_pose")
+            column.enabled = properties.use_native_pose
+            row = box.row()
+            row.prop(properties, "use_background_writer")
+            column = row.column()
+            column.prop(properties, "write_queue_size")
+            column.enabled = properties.use_background_writer
+            box.prop(properties, "use_profile")
+
+    def draw_cache(self, layout, properties):
+            box = layout.box()
+            box.prop(properties, "use_cache")
+
+            row = box.row()
+            row.prop(properties, "cache_size")
+            row.operator(VmdClearCache.bl_idname, text=pgettext(VmdClearCache.bl_label))
+            row.enabled = properties.use_cache
+
     def draw_version(self, layout, properties):
             box = layout.box()
             row = box.row()
@@ -203,16 +345,13 @@ class PMXArmaturePanel(ArmatureButtonsPanel, Panel):
         col = row.column(align=True)
         col.operator(VMDBoneSlotsActions.bl_idname, icon='CHECKBOX_HLT', text="").action = 'ALL'
         col.operator(VMDBoneSlotsActions.bl_idname, icon='CHECKBOX_DEHLT', text="").action = 'CLEAR'
+        col.operator(VMDBoneSlotsEditSelected.bl_idname, icon='GROUP_BONE', text="")
         col.menu("DATA_PT_bone_slots_specials", icon='DOWNARROW_HLT', text="")
 
-        if len(arm.bones) <= 0:
-            return
-        if len(arm.bones) <= vmd_armature_properties.active_bone_index:
+        if not 0 <= vmd_armature_properties.active_bone_index < len(arm.bones):
             return
 
-        bone_names = [bone.name for bone in arm.bones]
-        active_bone_name = bone_names[vmd_armature_properties.active_bone_index]
-        bone = arm.bones[active_bone_name]
+        bone = arm.bones[vmd_armature_properties.active_bone_index]
         vmd_bone_properties = bone.vmd_bone_properties
 
         layout.label(bone.name, translate=False, icon='BONE_DATA')
@@ -222,7 +361,68 @@ class PMXArmaturePanel(ArmatureButtonsPanel, Panel):
             logger.debug(vmd_bone_properties.mmd_parent)
         row.prop_search(vmd_bone_properties, "mmd_parent", arm, "bones", icon='CONSTRAINT_BONE')
 
+# アクティブなシェイプキーの MMD表情名 の設定を追加、削除する
+class VMDMorphNameActions(bpy.types.Operator):
+    bl_idname = "vmd.morph_name_actions"
+    bl_label = "MMD morph name"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    action = EnumProperty(items=(('ADD', "Add", ""), ('REMOVE', "Remove", "")))
+
+    @classmethod
+    def poll(cls, context):
+        return context.mesh and context.object.active_shape_key
+
+    def invoke(self, context, event):
+        mesh = context.mesh
+        name = context.object.active_shape_key.name
+        index = mesh.vmd_morph_names.find(name)
+
+        if self.action == 'ADD' and index < 0:
+            mesh.vmd_morph_names.add().name = name
+        elif self.action == 'REMOVE' and index >= 0:
+            mesh.vmd_morph_names.remove(index)
+
+        return {"FINISHED"}
+
+class MeshButtonsPanel:
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = "data"
+
+    @classmethod
+    def poll(cls, context):
+        return context.mesh and context.mesh.shape_keys and context.object.active_shape_key
+
+class VMDShapeKeyPanel(MeshButtonsPanel, Panel):
+    bl_idname = "DATA_PT_vmd_shape_key"
+    bl_label = "VMD Morph"
+
+    def draw(self, context):
+        key_block = context.object.active_shape_key
+        layout = self.layout
+        row = layout.row()
+        row.label(key_block.name, translate=False, icon='SHAPEKEY_DATA')
+
+        vmd_morph_properties = context.mesh.vmd_morph_names.get(key_block.name)
+        if vmd_morph_properties is None:
+            row.operator(VMDMorphNameActions.bl_idname, icon='ZOOMIN', text="").action = 'ADD'
+            layout.label("The shape key name is exported as is")
+            return
+        row.operator(VMDMorphNameActions.bl_idname, icon='X', text="").action = 'REMOVE'
+        layout.prop(vmd_morph_properties, "mmd_name")
+
+# 絞り込みと並べ替えの結果はボーンの設定が変わるまで使い回す (再描画で全ボーンを見ない)
 class OBJECT_UL_bone_slots(bpy.types.UIList):
+    filter_export = EnumProperty(
+        name="Export filter",
+        items=(('ALL', "All", ""), ('EXPORT', "Exported", ""), ('SKIP', "Not exported", ""))
+    )
+
+    revision = 0
+    # アーマチュアのポインタ -> (キー, flt_flags, flt_neworder)
+    filter_cache = {}
+
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
         vmd_bone_properties = item.vmd_bone_properties
         column = layout.column()
@@ -240,6 +440,46 @@ class OBJECT_UL_bone_slots(bpy.types.UIList):
         column.alignment = 'RIGHT'
         column.prop(vmd_bone_properties, "export", text="")
 
+    def draw_filter(self, context, layout):
+        row = layout.row()
+        row.prop(self, "filter_name", text="")
+        row.prop(self, "use_filter_invert", text="", icon='ARROW_LEFTRIGHT')
+        row = layout.row(align=True)
+        row.prop(self, "filter_export", expand=True)
+        row.prop(self, "use_filter_sort_alpha", text="", icon='SORTALPHA')
+        row.prop(self, "use_filter_sort_reverse", text="", icon='SORT_DESC' if self.use_filter_sort_reverse else 'SORT_ASC')
+
+    # ボーン名か MMD ボーン名が filter_name に一致し、出力の設定が filter_export に合うボーンを表示する
+    def filter_items(self, context, data, propname):
+        if not self.filter_name and self.filter_export == 'ALL' and not self.use_filter_sort_alpha:
+            return [], []
+
+        bones = getattr(data, propname)
+        # ボーン名の変更は検知できないので、ボーン数と最初と最後の名前もキーに入れる
+        key = (self.revision, self.filter_name, self.filter_export, self.use_filter_sort_alpha,
+            len(bones), bones[0].name if bones else "", bones[-1].name if bones else "")
+        cached = self.filter_cache.get(data.as_pointer())
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+        pattern = "*" + self.filter_name.lower() + "*"
+        flt_flags = []
+        for bone in bones:
+            vmd_bone_properties = bone.vmd_bone_properties
+            visible = True
+            if self.filter_export == 'EXPORT':
+                visible = vmd_bone_properties.export
+            elif self.filter_export == 'SKIP':
+                visible = not vmd_bone_properties.export
+            if visible and self.filter_name:
+                visible = fnmatch.fnmatchcase(bone.name.lower(), pattern) or fnmatch.fnmatchcase(vmd_bone_properties.mmd_name.lower(), pattern)
+            flt_flags.append(self.bitflag_filter_item if visible else 0)
+
+        flt_neworder = bpy.types.UI_UL_list.sort_items_by_name(bones, "name") if self.use_filter_sort_alpha else []
+
+        self.filter_cache[data.as_pointer()] = (key, flt_flags, flt_neworder)
+        return flt_flags, flt_neworder
+
     def invoke(self, context, event):
         pass
 
@@ -248,28 +488,65 @@ translations = {
         # Armature
         ("*", "Base Settings"): "基本設定",
         ("*", "Expanded Settings"): "拡張設定",
+        ("*", "Run in background"): "バックグラウンドで実行",
+        ("*", "Frames per step"): "1回に処理するフレーム数",
+        ("*", "Worker processes"): "ワーカープロセス数",
+        ("*", "Write in background"): "バックグラウンドで書き込む",
+        ("*", "Native pose evaluation"): "ポーズを直接計算",
+        ("*", "Verify native pose"): "計算したポーズを検証",
+        ("*", "Write queue size"): "書き込みキューのサイズ",
+        ("*", "Morph mesh"): "表情のメッシュ",
+        ("*", "Set the focus distance or focus object of the camera"): "カメラのピントの距離かオブジェクトを設定してください",
+        ("*", "MMD morph name"): "MMD表情名",
+        ("*", "The shape key name is exported as is"): "シェイプキー名をそのまま出力します",
+        ("*", "Camera"): "カメラ",
+        ("*", "Light"): "照明",
+        ("*", "Incremental export"): "差分エクスポート",
+        ("*", "Cache size (MB)"): "キャッシュサイズ (MB)",
+        ("*", "Clear cache"): "キャッシュを削除",
+        ("*", "Profile export"): "エクスポートをプロファイル",
+        ("*", "Export all armatures"): "全アーマチュアをエクスポート",
+        ("*", "Combine VMD files"): "VMDファイルを結合",
+        ("*", "Output file name"): "出力ファイル名",
+        ("*", "Frame offsets"): "フレームオフセット",
         ("*", "Use version"): "バージョンNo.を使う",
         ("*", "Auto increment version number"): "自動更新",
         ("*", "Version format"): "フォーマット形式",
         ("*", "Export folder"): "エクスポートフォルダ",
         ("*", "Use merker mode"): "マーカーモードを使用",
+        ("*", "Use keyframe frames"): "キーフレームのあるフレームを使用",
         ("*", "Frame offset"): "フレームオフセット",
         ("*", "Location scale"): "スケール",
+        ("*", "Keyframes only"): "キーフレームのみ出力",
+        ("*", "Reduce keyframes"): "キーフレームを削減",
+        ("*", "Remove duplicate keys"): "重複したキーフレームを削除",
+        ("*", "Location tolerance"): "位置の許容誤差",
+        ("*", "Angle tolerance"): "角度の許容誤差",
         # Bone Slots
         ("*", "MMD bone name"): "MMDボーン名",
         ("*", "MMD parent bone"): "MMD親ボーン",
         ("*", "Convert L/R to Japanese"): "L/R を 左/右 に変換",
         ("*", "Clear all mmd bone name"): "MMDボーン名を全てクリア",
+        ("*", "Edit selected bones"): "選択したボーンを編集",
+        ("*", "Set MMD parent bone"): "MMD親ボーンを設定",
+        ("*", "Clear MMD bone name"): "MMDボーン名をクリア",
+        ("*", "Don't export"): "出力しない",
+        ("*", "Keep"): "変更しない",
+        ("*", "Exported"): "出力する",
+        ("*", "Not exported"): "出力しない",
+        ("*", "No bones selected"): "ボーンが選択されていません",
     }
 }
 
 def register():
     bpy.types.Scene.vmd_scene_properties = PointerProperty(type=VMDSceneProperties)
     bpy.types.Bone.vmd_bone_properties = PointerProperty(type=VMDBoneProperties)
+    bpy.types.Mesh.vmd_morph_names = CollectionProperty(type=VMDMorphProperties)
     bpy.types.Armature.vmd_armature_properties = PointerProperty(type=VMDArmatureProperties)
     bpy.app.translations.register(__name__, translations)
 
 def unregister():
     bpy.app.translations.unregister(__name__)
     del bpy.types.Armature.vmd_armature_properties
+    del bpy.types.Mesh.vmd_morph_names
     del bpy.types.Bone.vmd_bone_properties
@@ -0,0 +1,118 @@
+import numpy
+
+# ボーンと同じフレームのループで値を読むもの (表情、カメラ、照明) の共通部分
+# サブクラスは sample で frames と values に追加する
+class FrameSampler():
+    def __init__(self):
+        self.frames = []
+        self.values = []
+
+    # まだ値を読んでいないフレーム
+    def missing_frames(self, frames):
+        sampled = set(self.frames)
+        return [frame for frame in frames if frame not in sampled]
+
+# 出力するボーンのポーズ行列をまとめて読み、親に対する位置と回転を配列で求める
+class PoseSampler():
+    def __init__(self, pose, bone_table, scale):
+        self.pose = pose
+        self.scale = scale
+
+        index_map = {bone.name: i for i, bone in enumerate(pose.bones)}
+        self.bone_size = len(pose.bones)
+
+        # 親がないボーンは末尾に足した単位行列を親にする
+        root = self.bone_size
+        self.child_indices = numpy.array([index_map[entry.pose_bone.name] for entry in bone_table], dtype=numpy.intp)
+        self.parent_indices = numpy.array([root if entry.parent is None else index_map[entry.parent.name] for entry in bone_table], dtype=numpy.intp)
+
+        identity = numpy.identity(4)
+        self.rest_inverted = numpy.array([matrix_to_array(entry.rest_inverted) for entry in bone_table])
+        self.parent_rest_inverted = numpy.array([identity if entry.parent is None else matrix_to_array(entry.parent_rest_inverted) for entry in bone_table])
+        self.offsets = numpy.array([tuple(entry.offset) for entry in bone_table])
+
+        self.buffer = numpy.empty(self.bone_size * 16, dtype=numpy.float32)
+        self.matrices = numpy.empty((self.bone_size + 1, 4, 4))
+        self.matrices[root] = identity
+
+    # 現在のフレームの (位置 (N, 3), 回転 (N, 4)) を VMD の座標系で返す
+    # matrices (全ボーンのポーズ行列) がある場合はポーズを読まずにそれを使う
+    def sample(self, matrices=None):
+        self.matrices[:self.bone_size] = self.read_matrices() if matrices is None else matrices
+
+        matrix = self.matrices[self.child_indices]
+        parent_matrix = self.matrices[self.parent_indices]
+
+        translation = numpy.matmul(numpy.linalg.inv(parent_matrix), matrix)[:, :3, 3]
+        # Vector * Matrix と同じく行ベクトルとして掛ける
+        location_local = numpy.einsum("ni,nij->nj", translation, self.parent_rest_inverted[:, :3, :3]) + self.parent_rest_inverted[:, 3, :3]
+        location_mmd = location_local - self.offsets
+
+        quaternion = matrix_to_quaternion(numpy.matmul(matrix, self.rest_inverted)[:, :3, :3])
+        quaternion_parent = matrix_to_quaternion(numpy.matmul(parent_matrix, self.parent_rest_inverted)[:, :3, :3])
+        quaternion_mmd = quaternion_difference(quaternion_parent, quaternion)
+
+        return convert_locations(location_mmd, self.scale), convert_quaternions(quaternion_mmd)
+
+    # 現在のフレームの全ボーンのポーズ行列 (ボーン数, 4, 4)
+    def read_matrices(self):
+        # foreach_get は列優先で返すので転置する
+        self.pose.bones.foreach_get("matrix", self.buffer)
+        return self.buffer.reshape(self.bone_size, 4, 4).transpose(0, 2, 1)
+
+def matrix_to_array(matrix):
+    return numpy.array([tuple(row) for row in matrix])
+
+# 回転行列 (N, 3, 3) を (w, x, y, z) のクォータニオン (N, 4) にする
+def matrix_to_quaternion(matrix):
+    # スケールを除く
+    matrix = matrix / numpy.linalg.norm(matrix, axis=1)[:, numpy.newaxis, :]
+
+    m00 = matrix[:, 0, 0]
+    m11 = matrix[:, 1, 1]
+    m22 = matrix[:, 2, 2]
+    trace = m00 + m11 + m22
+
+    case = numpy.argmax(numpy.stack([trace, m00, m11, m22], axis=1), axis=1)
+    diagonal = numpy.stack([trace, 2.0 * m00 - trace, 2.0 * m11 - trace, 2.0 * m22 - trace], axis=1)
+    s = 2.0 * numpy.sqrt(numpy.maximum(1.0 + diagonal[numpy.arange(len(case)), case], 1e-12))
+
+    w_x = matrix[:, 2, 1] - matrix[:, 1, 2]
+    w_y = matrix[:, 0, 2] - matrix[:, 2, 0]
+    w_z = matrix[:, 1, 0] - matrix[:, 0, 1]
+    x_y = matrix[:, 0, 1] + matrix[:, 1, 0]
+    x_z = matrix[:, 0, 2] + matrix[:, 2, 0]
+    y_z = matrix[:, 1, 2] + matrix[:, 2, 1]
+    quarter = 0.25 * s
+
+    quaternion = numpy.select(
+        [case[:, numpy.newaxis] == i for i in range(4)],
+        [
+            numpy.stack([quarter, w_x / s, w_y / s, w_z / s], axis=1),
+            numpy.stack([w_x / s, quarter, x_y / s, x_z / s], axis=1),
+            numpy.stack([w_y / s, x_y / s, quarter, y_z / s], axis=1),
+            numpy.stack([w_z / s, x_z / s, y_z / s, quarter], axis=1),
+        ])
+
+    quaternion /= numpy.linalg.norm(quaternion, axis=1)[:, numpy.newaxis]
+    quaternion[quaternion[:, 0] < 0.0] *= -1.0
+    return quaternion
+
+# a.rotation_difference(b) と同じく a^-1 * b を返す
+def quaternion_difference(a, b):
+    a_w = a[:, 0]
+    a_v = -a[:, 1:]
+    b_w = b[:, 0]
+    b_v = b[:, 1:]
+
+    w = a_w * b_w - numpy.einsum("ni,ni->n", a_v, b_v)
+    v = a_w[:, numpy.newaxis] * b_v + b_w[:, numpy.newaxis] * a_v + numpy.cross(a_v, b_v)
+    return numpy.concatenate([w[:, numpy.newaxis], v], axis=1)
+
+# VMD の X, Y, Z は Blender の X, Z, Y
+def convert_locations(locations, scale):
+    return locations[:, [0, 2, 1]] * scale
+
+# (w, x, y, z) を VMD の (x, y, z, w) にする
+def convert_quaternions(quaternions):
+    return numpy.stack([-quaternions[:, 1], -quaternions[:, 3], -quaternions[:, 2], quaternions[:, 0]], axis=1)
@@ -0,0 +1,165 @@
+import bpy
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from . import const, timing
+from . core import encoder, writer
+from . batch import script_args
+from . exporter import Exporter
+
+logger = logging.getLogger(const.ADDON_NAME)
+
+# フレームを分割して別の Blender プロセスで評価し、1 つの VMD にまとめる
+# 各プロセスはシーンのコピーを開き、担当するフレームのボーンキーフレームだけを書き出す
+# フレーム順につなげるので、1 プロセスで出力した場合と同じバイト列になる
+
+# 出力できた場合は True を返す
+def export_sharded(exporter, workers):
+    if exporter.check_data() is False:
+        return False
+
+    if workers <= 1:
+        return exporter.export_vmd()
+    reason = exporter.shard_reason()
+    if reason is not None:
+        logger.warning("export in this process (" + reason + " needs a single process)")
+        return exporter.export_vmd()
+
+    exporter.stage_timer = timing.StageTimer()
+    exporter.prepare()
+    frames = exporter.export_frames()
+    shards = split_frames(frames, workers)
+    logger.info("shards : " + str(len(shards)) + ", frames : " + str(len(frames)))
+
+    temp_dir = tempfile.mkdtemp(prefix=const.ADDON_NAME)
+    try:
+        blend_path = os.path.join(temp_dir, "scene.blend")
+        with exporter.stage_timer.stage("save_blend"):
+            bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True)
+
+        part_paths = [os.path.join(temp_dir, "part{0}.bin".format(i)) for i in range(len(shards))]
+        with exporter.stage_timer.stage("workers"):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as pool:
+                futures = [pool.submit(run_shard, blend_path, exporter.obj.name, shard, part_path) for shard, part_path in zip(shards, part_paths)]
+                for future in futures:
+                    future.result()
+
+        merge_parts(exporter, shards, part_paths)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    exporter.stage_timer.finish(len(frames))
+    for line in exporter.stage_timer.lines():
+        logger.info(line)
+    return exporter.exported
+
+# なるべく同じ数になるように連続したフレームに分ける
+def split_frames(frames, workers):
+    size = min(workers, len(frames))
+    shards = []
+    start = 0
+    for i in range(size):
+        end = start + (len(frames) - start) // (size - i)
+        shards.append(frames[start:end])
+        start = end
+    return shards
+
+def run_shard(blend_path, armature, frames, part_path):
+    spec_path = part_path + ".json"
+    with open(spec_path, "w", encoding="utf-8") as file:
+        json.dump({"armature": armature, "frames": frames, "part": part_path}, file)
+
+    command = [
+        bpy.app.binary_path, "-b", blend_path,
+        "--addons", __package__,
+        "--python-expr", "import {0}.shard as s; s.worker_main()".format(__package__),
+        "--", spec_path]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if process.returncode != 0:
+        raise RuntimeError("shard {0} - {1} failed :\n{2}".format(frames[0], frames[-1], process.stdout.decode("utf-8", "replace")[-4000:]))
+
+def merge_parts(exporter, shards, part_paths):
+    record_size = encoder.BONE_RECORD.size * len(exporter.bone_table)
+    count = 0
+    for frames, part_path in zip(shards, part_paths):
+        if os.path.getsize(part_path) != record_size * len(frames):
+            raise RuntimeError("broken shard : " + part_path)
+        count += len(frames) * len(exporter.bone_table)
+
+    with writer.atomic_file(exporter.path) as raw_file:
+        file = timing.TimedFile(raw_file, exporter.stage_timer)
+        exporter.write_header(file)
+        exporter.write_long(file, count)
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, file)
+        exporter.write_counts(file)
+    exporter.exported = True
+
+# シャードを評価するプロセスの入口
+def worker_main():
+    args = script_args()
+    try:
+        with open(args[0], encoding="utf-8") as file:
+            spec = json.load(file)
+
+        exporter = Exporter(bpy.context.scene, bpy.data.objects[spec["armature"]])
+        exporter.output_path = spec["part"]
+        exporter.prepare()
+
+        with open(spec["part"], "wb") as file:
+            for frame in exporter.write_bone_frames(file, spec["frames"]):
+                pass
+    except Exception:
+        logger.exception("shard failed")
+        sys.exit(1)
+
+# ワーカー数ごとの時間を測り、1 プロセスの出力と一致するか確かめる
+#
+# blender -b scene.blend --addons vmd_exporter --python-expr "import vmd_exporter.shard as s; s.benchmark_main()" -- Armature 1 2 4 8
+def benchmark(scene, obj, worker_counts):
+    results = []
+    temp_dir = tempfile.mkdtemp(prefix=const.ADDON_NAME)
+    try:
+        serial = None
+        for workers in worker_counts:
+            exporter = Exporter(scene, obj)
+            exporter.output_path = os.path.join(temp_dir, "workers{0}.vmd".format(workers))
+
+            time_start = time.perf_counter()
+            if workers <= 1:
+                exporter.export_vmd()
+            else:
+                export_sharded(exporter, workers)
+            seconds = time.perf_counter() - time_start
+
+            with open(exporter.output_path, "rb") as file:
+                data = file.read()
+            if serial is None:
+                serial = (seconds, data)
+
+            results.append({
+                "workers": workers,
+                "seconds": seconds,
+                "speedup": serial[0] / seconds if seconds > 0.0 else 0.0,
+                "identical": data == serial[1],
+            })
+            logger.info("workers : {0}, {1:.3f} sec, x{2:.2f}, identical : {3}".format(workers, seconds, results[-1]["speedup"], results[-1]["identical"]))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+def benchmark_main():
+    args = script_args()
+    worker_counts = [int(arg) for arg in args[1:]] or [1, 2, 4]
+    if worker_counts[0] != 1:
+        worker_counts.insert(0, 1)
+
+    results = benchmark(bpy.context.scene, bpy.data.objects[args[0]], worker_counts)
+    print(json.dumps(results, indent=2))
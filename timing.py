@@ -0,0 +1,87 @@
+import collections
+import contextlib
+import time
+
+# エクスポートの段階ごとの累積時間と呼び出し回数
+# 段階は最初に計測した順に並べる
+class StageTimer():
+    def __init__(self):
+        self.seconds = collections.OrderedDict()
+        self.calls = collections.OrderedDict()
+        self.frame_count = 0
+        self.bytes_written = 0
+        self.time_start = time.perf_counter()
+        self.elapsed = 0.0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - time_start)
+
+    def add(self, name, seconds, calls=1):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def finish(self, frame_count):
+        self.frame_count = frame_count
+        self.elapsed = time.perf_counter() - self.time_start
+
+    @property
+    def fps(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.frame_count / self.elapsed
+
+    # 1 行目が全体、2 行目以降が段階ごと (計測していない時間は other)
+    def lines(self):
+        lines = ["{0} frames in {1:.3f} sec ({2:.1f} fps), {3} bytes written".format(
+            self.frame_count, self.elapsed, self.fps, self.bytes_written)]
+
+        stages = list(self.seconds.items())
+        stages.append(("other", max(self.elapsed - sum(self.seconds.values()), 0.0)))
+        for name, seconds in stages:
+            percent = seconds / self.elapsed * 100.0 if self.elapsed > 0.0 else 0.0
+            calls = self.calls.get(name)
+            lines.append("  {0:12s} {1:9.3f} sec {2:5.1f}%{3}".format(
+                name, seconds, percent, " ({0} calls)".format(calls) if calls is not None else ""))
+        return lines
+
+    def __str__(self):
+        return "\n".join(self.lines())
+
+# 書き込みの時間とバイト数を StageTimer に記録するファイル
+class TimedFile():
+    def __init__(self, file, stage_timer):
+        self.file = file
+        self.stage_timer = stage_timer
+
+    def write(self, data):
+        time_start = time.perf_counter()
+        size = self.file.write(data)
+        self.stage_timer.add("write", time.perf_counter() - time_start)
+        self.stage_timer.bytes_written += len(data)
+        return size
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+# steps を進めている間だけ profile を有効にする (モーダル実行中の他の処理を含めない)
+def profile_steps(steps, profile):
+    try:
+        while True:
+            profile.enable()
+            try:
+                step = next(steps)
+            except StopIteration:
+                return
+            finally:
+                profile.disable()
+            yield step
+    finally:
+        steps.close()